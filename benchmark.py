@@ -0,0 +1,304 @@
+"""
+Times every image operation on generated images, without connecting to Discord.
+
+    python benchmark.py -o results.json
+    python benchmark.py --baseline results.json --threshold 0.2
+
+Results are written as JSON with percentiles in milliseconds and the peak memory of one run.
+With --baseline the median of every case is compared with the stored one, and the exit
+status is 1 if any case got slower by more than the threshold.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import gc
+import io
+import json
+import math
+import os
+import platform
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+import PIL
+from PIL import Image
+from cogs.encoder import encode
+from cogs.filters import filters, advanced_filters, impact
+from cogs.frames import apply_frame, apply_template, detect_template, template_layers
+from cogs.image_handling import open_image, SourceImage
+from cogs.pipeline import parse_pipe, optimize
+from cogs.registry import Asset
+from cogs import render
+
+
+# the sizes images have after open_image shrinks them, and the sizes they're uploaded at
+SIZES = [(200, 150), (800, 600)]
+UPLOAD_SIZES = [(1024, 768), (3000, 2000)]
+# the modes images are uploaded in, they're opened like open_image does so P ones are converted
+MODES = ['RGB', 'RGBA', 'L', 'P']
+ORIENTATIONS = [1, 6, 8]
+ADVANCED_ARGUMENTS = {'symm': 'left', 'shrink': 50, 'rotate': 'right',
+                      'brightness': 150, 'contrast': 150, 'threshold': 128, 'gamma': 2.2}
+TEMPLATE_BOX = (100, 80, 500, 380)
+PIPES = [
+    'invert grayscale shrink 50',
+    'rotate left fliph rotate right flipv posterize',
+    'shrink 50 shrink 50 transparent posterize',
+    'bench_frame glitch',
+    'bench_template edges symm',
+    'invert posterize invert brightness 120 contrast 130',
+]
+ANIMATION_FRAMES = 24
+
+
+def generate_image(size, mode='RGB'):
+    """A photo-like image, smooth gradients with some noise, converted to 'mode'"""
+    red = Image.linear_gradient('L').resize(size)
+    green = Image.effect_noise(size, 40)
+    blue = Image.radial_gradient('L').resize(size)
+    image = Image.merge('RGB', (red, green, blue))
+    if mode == 'RGBA':
+        image.putalpha(Image.linear_gradient('L').rotate(90).resize(size))
+    elif mode == 'P':
+        image = image.quantize(64)
+    elif mode != 'RGB':
+        image = image.convert(mode)
+    return image
+
+
+def opened(image):
+    """'image' the way operations get it once it's uploaded and opened with open_image, at the same size"""
+    f = io.BytesIO()
+    image.save(f, format='PNG')
+    image = open_image(f, None)
+    image.load()
+    return image
+
+
+def generate_frame(size=(600, 450)):
+    """An opaque border around a transparent middle"""
+    frame = Image.new('RGBA', size, (200, 40, 40, 255))
+    frame.paste((0, 0, 0, 0), (40, 40, size[0] - 40, size[1] - 40))
+    return frame
+
+
+def generate_template(size=(600, 450)):
+    template = generate_image(size).convert('RGBA')
+    template.paste((0, 0, 0, 0), TEMPLATE_BOX)
+    return template
+
+
+def generate_upload(size, format, orientation=1):
+    """The bytes of an uploaded image, with an EXIF orientation if the format has EXIF"""
+    image = generate_image(size)
+    params = {}
+    if format == 'JPEG':
+        exif = Image.Exif()
+        exif[274] = orientation
+        params = {'exif': exif.tobytes(), 'quality': 90}
+    with io.BytesIO() as f:
+        image.save(f, format=format, **params)
+        return f.getvalue()
+
+
+def generate_animation(size=(400, 300), frames=ANIMATION_FRAMES):
+    images = [generate_image(size).rotate(i * 360 / frames) for i in range(frames)]
+    with io.BytesIO() as f:
+        images[0].save(f, format='GIF', save_all=True, append_images=images[1:], duration=50, loop=0)
+        return f.getvalue()
+
+
+def cases(workspace):
+    """Yields (name, make_input, run) for every case, 'make_input' isn't timed"""
+    images = {(size, mode): opened(generate_image(size, mode)) for size in SIZES for mode in MODES}
+
+    def each_image():
+        for (size, mode), image in images.items():
+            yield f'{size[0]}x{size[1]}-{mode}', image
+
+    for label, image in each_image():
+        for name, f in filters.items():
+            yield f'filter:{name}:{label}', image.copy, f
+        for name, f in advanced_filters.items():
+            argument = ADVANCED_ARGUMENTS[name]
+            yield f'filter:{name}:{label}', image.copy, lambda image, f=f, argument=argument: f(image, argument)
+        yield f'impact:{label}', image.copy, lambda image: impact(image, 'benchmark top text', 'and the bottom one')
+
+    frame = generate_frame()
+    template = generate_template()
+    layers = template_layers(template, (TEMPLATE_BOX,))
+    frame.save(os.path.join(workspace, 'frames', 'bench_frame.png'))
+    template.save(os.path.join(workspace, 'frames', 'bench_template.png'))
+    for label, image in each_image():
+        yield f'apply_frame:{label}', image.copy, lambda image: apply_frame(image, frame)
+        yield f'apply_template:{label}', image.copy, lambda image: apply_template(image, layers)
+        # encoding is the part of send_image that doesn't depend on Discord
+        yield f'encode:{label}', image.copy, lambda image: encode(image, render.job_counters)
+    yield 'detect_template', template.copy, detect_template
+
+    for size in UPLOAD_SIZES:
+        for orientation in ORIENTATIONS:
+            data = generate_upload(size, 'JPEG', orientation)
+            yield (f'open_image:{size[0]}x{size[1]}-JPEG-orientation{orientation}',
+                   lambda data=data: io.BytesIO(data), lambda f: open_image(f).load())
+        data = generate_upload(size, 'PNG')
+        yield f'open_image:{size[0]}x{size[1]}-PNG', lambda data=data: io.BytesIO(data), lambda f: open_image(f).load()
+
+    image = images[((800, 600), 'RGB')]
+    assets = {
+        'bench_frame': Asset('bench_frame', 'frame', *frame.size, None, '', 0),
+        'bench_template': Asset('bench_template', 'template', *template.size, (TEMPLATE_BOX,), '', 0),
+    }
+    for pipe in PIPES:
+        operations = tuple(parse_pipe(pipe, assets))
+        plan = optimize(operations)
+        yield f'pipe:{pipe}', image.copy, lambda image, plan=plan: render.apply_operations(image, plan)
+        yield (f'pipe-unoptimized:{pipe}', image.copy,
+               lambda image, operations=operations: render.apply_operations(image, operations))
+
+    source = SourceImage(generate_animation(), 0)
+    yield ('animation:invert', lambda: source,
+           lambda source: render.render_frames(source, [('invert',)], 0, ANIMATION_FRAMES))
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of the sorted list 'ordered'"""
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _rss_high_water():
+    """The process' peak resident memory in KiB since it was last reset, or None if unknown"""
+    try:
+        with open('/proc/self/status') as f:
+            return int(re.search(r'VmHWM:\s+(\d+)', f.read()).group(1))
+    except (OSError, AttributeError):
+        return None
+
+
+def _reset_rss_high_water():
+    gc.collect()
+    # hand memory freed by earlier runs back to the OS, otherwise reusing it wouldn't show up
+    try:
+        ctypes.CDLL(ctypes.util.find_library('c')).malloc_trim(0)
+    except (OSError, AttributeError, TypeError):
+        pass
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_memory(make_input, run):
+    """
+    How many MiB one run allocated at its peak.
+    Pillow allocates pixels outside of Python, so the resident memory high-water mark is used
+    where the OS lets it be reset, otherwise only Python allocations are seen through tracemalloc.
+    """
+    argument = make_input()
+    if _reset_rss_high_water():
+        before = _rss_high_water()
+        run(argument)
+        return (_rss_high_water() - before) / 1024
+    tracemalloc.start()
+    try:
+        run(argument)
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def measure(make_input, run, repeat):
+    run(make_input())  # warm up caches, fonts and lazy imports
+    timings = []
+    for _ in range(repeat):
+        argument = make_input()
+        start = time.perf_counter()
+        run(argument)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        'runs': repeat,
+        'min': timings[0],
+        'p50': percentile(timings, 0.5),
+        'p90': percentile(timings, 0.9),
+        'p99': percentile(timings, 0.99),
+        'max': timings[-1],
+        'mean': sum(timings) / repeat,
+        'peak_mib': peak_memory(make_input, run),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Returns (name, baseline median, median) of every case whose median grew by more than 'threshold'"""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before or 'p50' not in before or 'p50' not in result:
+            continue
+        if result['p50'] > before['p50'] * (1 + threshold):
+            regressions.append((name, before['p50'], result['p50']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', help="where to write the JSON results, stdout if not given")
+    parser.add_argument('-n', '--repeat', type=int, default=10, help="timed runs per case")
+    parser.add_argument('-k', '--select', default='', help="only run cases whose name contains this")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="how much slower than the baseline a median can be, 0.2 is 20%%")
+    args = parser.parse_args(argv)
+
+    results = {}
+    repo = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as workspace:
+        # operations find frames and fonts relative to the working directory, like the bot does
+        os.mkdir(os.path.join(workspace, 'frames'))
+        os.symlink(os.path.join(repo, 'fonts'), os.path.join(workspace, 'fonts'))
+        cwd = os.getcwd()
+        os.chdir(workspace)
+        try:
+            for name, make_input, run in cases(workspace):
+                if args.select not in name:
+                    continue
+                try:
+                    results[name] = measure(make_input, run, args.repeat)
+                except Exception as e:
+                    results[name] = {'error': f'{type(e).__name__}: {e}'}
+                print(f"{name:70} {results[name].get('p50', float('nan')):9.2f} ms", file=sys.stderr)
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after in regressions:
+            print(f"Regression: {name} {before:.2f} ms -> {after:.2f} ms", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"No case is more than {args.threshold:.0%} slower than the baseline.", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,30 +2,76 @@ import discord
 from discord.ext import commands
 import logging
 import os
+from cogs.render import RenderEngine
+from cogs.image_index import ImageIndex
+from cogs.upload_index import UploadIndex
+from cogs.cache import LRUCache, SingleFlightCache
+from cogs.download import Downloader
+from cogs.memory import MemoryBudget
+from cogs.metrics import Metrics
+from cogs.registry import AssetRegistry
+from cogs.scheduler import Scheduler, JOB_CONCURRENCY
 
 logging.basicConfig(filename="monarchbot.log", level=logging.INFO)
 
 initial_extensions = ['cogs.frames',
-                      'cogs.filters']
+                      'cogs.filters',
+                      'cogs.image_index',
+                      'cogs.upload_index',
+                      'cogs.stats']
 
 prefix = "-"
-bot = commands.Bot(command_prefix=prefix)
 
-if __name__ == '__main__':
+
+def create_bot(shard_ids=None, shard_count=None, render_engine=None, memory_budget=None):
+    """
+    Creates the bot with every extension loaded.
+    With 'shard_ids' it only connects those of 'shard_count' shards, see cluster.py.
+    """
+    if shard_ids is None:
+        bot = commands.Bot(command_prefix=prefix)
+    else:
+        bot = commands.AutoShardedBot(command_prefix=prefix, shard_ids=shard_ids, shard_count=shard_count)
+    # stage latencies of every command, see cogs.stats
+    bot.metrics = Metrics()
+    if render_engine is None:
+        render_engine = RenderEngine()
+    render_engine.metrics = bot.metrics
+    bot.render_engine = render_engine
+    # decides whose image is rendered next, see cogs.scheduler
+    bot.scheduler = Scheduler(JOB_CONCURRENCY or render_engine.workers)
+    # memory set aside for the images being rendered, see cogs.memory
+    bot.memory_budget = memory_budget or MemoryBudget()
+    bot.image_index = ImageIndex()
+    # where results were last uploaded, so identical ones are pointed at rather than uploaded again
+    bot.upload_index = UploadIndex()
+    # frames and templates, with their sizes and boxes
+    bot.asset_registry = AssetRegistry('frames')
+    # fetches uploads, refusing the ones too big to use before downloading them
+    bot.downloader = Downloader()
+    # downloaded attachments, keyed by attachment id
+    bot.source_cache = SingleFlightCache(LRUCache(max_bytes=32 * 2**20, ttl=10 * 60))
+    # rendered results, keyed by (attachment id, max size, operations)
+    bot.result_cache = SingleFlightCache(LRUCache(max_bytes=32 * 2**20, ttl=10 * 60,
+                                                  sizeof=lambda encoded: len(encoded.data)))
+
     for extension in initial_extensions:
         try:
             bot.load_extension(extension)
         except (discord.ClientException, ImportError):
             logging.warning(f'Failed to load extension {extension}.')
 
+    @bot.event
+    async def on_ready():
+        """http://discordpy.readthedocs.io/en/rewrite/api.html#discord.on_ready"""
 
-@bot.event
-async def on_ready():
-    """http://discordpy.readthedocs.io/en/rewrite/api.html#discord.on_ready"""
+        print(f'\n\nLogged in as: {bot.user.name} - {bot.user.id}\nVersion: {discord.__version__}\n')
 
-    print(f'\n\nLogged in as: {bot.user.name} - {bot.user.id}\nVersion: {discord.__version__}\n')
+        print(f'Successfully logged in and booted...!')
 
-    print(f'Successfully logged in and booted...!')
+    return bot
 
 
-bot.run(os.environ['TOKEN'], bot=True, reconnect=True)
+if __name__ == '__main__':
+    bot = create_bot()
+    bot.run(os.environ['TOKEN'], bot=True, reconnect=True)
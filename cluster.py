@@ -0,0 +1,109 @@
+"""
+Runs the bot as several processes that split the shards between them and share one render worker pool.
+
+    python3 cluster.py
+
+SHARD_COUNT is how many shards there are, by default what Discord recommends for the bot.
+CLUSTERS is how many bot processes they're split between, by default one per CPU.
+RENDER_WORKERS is the size of the shared render pool, by default one per CPU.
+MEMORY_BUDGET is for every process together, each one admits renders against its share of it.
+Every process keeps its own caches. Frames and templates are shared through the asset registry,
+which each process checks for changes made by the others.
+Processes that die are started again.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+import discord
+
+
+# how long to wait before starting a process that died again
+RESTART_DELAY = 5
+
+
+async def recommended_shards(token):
+    http = discord.http.HTTPClient()
+    try:
+        await http.static_login(token, bot=True)
+        shards, url = await http.get_bot_gateway()
+        return shards
+    finally:
+        await http.close()
+
+
+def reset_signals():
+    # processes started again are forked after main installed its handlers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+
+def run_server(socket_path, workers):
+    reset_signals()
+    from cogs.render_server import run_server
+    run_server(socket_path, workers)
+
+
+def run_cluster(index, shard_ids, shard_count, socket_path, workers, clusters):
+    """Runs the bot with 'shard_ids', rendering in the server at 'socket_path' with its share of the memory budget"""
+    reset_signals()
+    # each process serves its metrics on its own port, read when the stats cog is loaded
+    metrics_port = int(os.environ.get('METRICS_PORT', 9464))
+    if metrics_port:
+        os.environ['METRICS_PORT'] = str(metrics_port + index)
+    from bot import create_bot
+    from cogs.memory import MemoryBudget, MEMORY_BUDGET
+    from cogs.render_server import RemoteRenderEngine
+    bot = create_bot(shard_ids, shard_count, RemoteRenderEngine(socket_path, workers),
+                     MemoryBudget(MEMORY_BUDGET // clusters))
+    logging.info(f"Cluster {index} running shards {shard_ids} of {shard_count}.")
+    bot.run(os.environ['TOKEN'], bot=True, reconnect=True)
+
+
+def main():
+    logging.basicConfig(filename="monarchbot.log", level=logging.INFO)
+    token = os.environ['TOKEN']
+    shard_count = int(os.environ.get('SHARD_COUNT', 0)) or asyncio.run(recommended_shards(token))
+    clusters = min(int(os.environ.get('CLUSTERS', 0)) or os.cpu_count() or 1, shard_count)
+    workers = int(os.environ.get('RENDER_WORKERS', 0)) or os.cpu_count() or 1
+    socket_path = os.path.join(tempfile.mkdtemp(prefix='monarchbot-'), 'render.sock')
+
+    targets = {'render': (run_server, (socket_path, workers))}
+    for index in range(clusters):
+        shard_ids = list(range(index, shard_count, clusters))
+        targets[f'cluster {index}'] = (run_cluster, (index, shard_ids, shard_count, socket_path, workers, clusters))
+
+    def start(name):
+        target, args = targets[name]
+        process = multiprocessing.Process(target=target, args=args, name=name)
+        process.start()
+        return process
+
+    processes = {name: start(name) for name in targets}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logging.info(f"Started {clusters} clusters with {shard_count} shards and {workers} render workers.")
+    while not stopping:
+        time.sleep(RESTART_DELAY)
+        for name, process in processes.items():
+            if not process.is_alive() and not stopping:
+                logging.warning(f"{name} exited with {process.exitcode}, starting it again.")
+                processes[name] = start(name)
+
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+from PIL import Image
+from .cache import LRUCache, image_size
+from .image_handling import get_frame
+from .frames import template_layers
+
+
+class AssetStore:
+    """
+    Decoded frames and templates, frames already resized to the sizes they were used at
+    and the compositing layers of templates.
+    Assets are keyed by (name, version), the owner of the assets bumps the version when
+    one changes so stale copies are never used again and just age out.
+    """
+
+    def __init__(self, max_bytes=64 * 2**20, max_resized_bytes=64 * 2**20):
+        self.decoded = LRUCache(max_bytes, sizeof=image_size)
+        self.resized = LRUCache(max_resized_bytes, sizeof=image_size)
+        self.layers = LRUCache(max_resized_bytes, sizeof=_layers_size)
+
+    def _load(self, name, version):
+        image = self.decoded.get((name, version))
+        if image is None:
+            image = get_frame(name)
+            if image is None:
+                return None
+            image.load()
+            self.decoded.put((name, version), image)
+        return image
+
+    def frame(self, name, version, size=None):
+        """Returns the frame, resized to 'size' if given. It must not be modified."""
+        if size is None:
+            return self._load(name, version)
+        key = (name, version, size)
+        frame = self.resized.get(key)
+        if frame is None:
+            frame = self._load(name, version)
+            if frame is None:
+                return None
+            frame = frame.resize(size, Image.LANCZOS)
+            self.resized.put(key, frame)
+        return frame
+
+    def template_layers(self, name, version, boxes):
+        """Returns the TemplateLayers of the template with images in 'boxes', computed once per version"""
+        key = (name, version, boxes)
+        layers = self.layers.get(key)
+        if layers is None:
+            template = self._load(name, version)
+            if template is None:
+                return None
+            layers = template_layers(template, boxes)
+            self.layers.put(key, layers)
+        return layers
+
+
+def _layers_size(layers):
+    return image_size(layers.background) + sum(image_size(overlay[0]) for overlay in layers.overlays if overlay)
@@ -0,0 +1,133 @@
+import asyncio
+import collections
+import discord
+import io
+from .download import DownloadError
+from .encoder import UPLOAD_LIMIT
+from .image_handling import (get_message_attachments, read_attachment, render_cached, scheduled, RenderError,
+                             EXTENSIONS)
+from .scheduler import Rejected, Superseded
+
+
+# Discord takes at most this many files in a message
+BATCH_MAX = 10
+
+# 'count' is how many of the last images of the channel to use, or None for every image of the last message
+# with images. 'sheet' is whether to send a single contact sheet rather than every result.
+Batch = collections.namedtuple('Batch', 'count sheet')
+
+
+class BatchError(Exception):
+    """Raised when batch flags aren't valid, with a message that can be shown to the user"""
+
+
+def parse_batch(words):
+    """
+    Takes the batch flags out of 'words': '--all' for every image of the message, '--last N' for the
+    last N images of the channel and '--sheet' for a contact sheet of the results.
+    Returns the Batch, or None if there are no flags, and the rest of the words.
+    """
+    count = sheet = batch = None
+    rest = []
+    words = iter(words)
+    for word in words:
+        flag = word.lower()
+        if flag == '--all':
+            batch = True
+        elif flag == '--last':
+            try:
+                count = int(next(words, ''))
+            except ValueError:
+                raise BatchError("'--last' needs how many images to use.")
+            if not (1 <= count <= BATCH_MAX):
+                raise BatchError(f"'--last' can use between 1 and {BATCH_MAX} images.")
+            batch = True
+        elif flag == '--sheet':
+            sheet = batch = True
+        else:
+            rest.append(word)
+    if not batch:
+        return None, rest
+    return Batch(count, bool(sheet)), rest
+
+
+async def get_batch_attachments(ctx, count=None, limit=100):
+    """
+    Returns the image attachments of the batch and the messages they're in, oldest first
+    They're every image of the last message with images if 'count' is None, else the last 'count' images
+    of the channel, looking at most 'limit' messages back
+    """
+    async def messages():
+        yield ctx.message
+        async for message in ctx.history(before=ctx.message, limit=limit):
+            yield message
+
+    found = []
+    with ctx.bot.metrics.timer('history'):
+        async for message in messages():
+            attachments = get_message_attachments(message)
+            if count is None:
+                if attachments:
+                    return [(attachment, message) for attachment in attachments]
+                continue
+            for attachment in reversed(attachments):
+                found.append((attachment, message))
+                if len(found) == count:
+                    return found[::-1]
+    return found[::-1]
+
+
+async def run_batch(ctx, words, operations):
+    """Runs 'operations' as a batch if 'words' has batch flags, returns whether it did"""
+    try:
+        batch, rest = parse_batch(words)
+    except BatchError as e:
+        await ctx.send(str(e))
+        return True
+    if batch is None:
+        return False
+    await process_batch(ctx, batch, operations)
+    return True
+
+
+async def process_batch(ctx, batch, operations):
+    """Renders 'operations' on every image of 'batch' at once and sends the results in a single message"""
+    await ctx.trigger_typing()
+    attachments = await get_batch_attachments(ctx, batch.count)
+    if not attachments:
+        return await ctx.send("Couldn't find valid image.")
+
+    async def render(attachment):
+        image = await read_attachment(ctx, attachment)
+        return await render_cached(ctx, image, operations)
+
+    try:
+        # the whole batch is a single job for the scheduler, the render engine spreads it over the workers
+        async with scheduled(ctx):
+            results = await asyncio.gather(*(render(attachment) for attachment, message in attachments),
+                                           return_exceptions=True)
+            encoded = []
+            for result in results:
+                if isinstance(result, (RenderError, DownloadError, IOError, discord.HTTPException)):
+                    continue
+                if isinstance(result, BaseException):
+                    raise result
+                encoded.append(result)
+            if not encoded:
+                return await ctx.send("None of those images could be used.")
+            failed = len(results) - len(encoded)
+            if batch.sheet or len(encoded) > BATCH_MAX or sum(len(result.data) for result in encoded) > UPLOAD_LIMIT:
+                encoded = [await ctx.bot.render_engine.contact_sheet(encoded)]
+    except Superseded:
+        return
+    except (RenderError, Rejected) as e:
+        return await ctx.send(str(e))
+
+    with ctx.bot.metrics.timer('upload'):
+        files = [discord.File(io.BytesIO(result.data), filename=f'{ctx.invoked_with}{i}.{EXTENSIONS[result.format]}')
+                 for i, result in enumerate(encoded, 1)]
+        await ctx.send(f"Skipped {failed} image{'s' if failed > 1 else ''} that couldn't be used." if failed else None, files=files)
+    try:
+        await ctx.message.delete()
+    except discord.Forbidden:
+        pass
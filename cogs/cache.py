@@ -0,0 +1,152 @@
+import asyncio
+import collections
+import time
+
+
+def image_size(image):
+    """Approximate number of bytes the pixels of 'image' take"""
+    return image.width * image.height * len(image.getbands())
+
+
+class LRUCache:
+    """
+    A least recently used cache bounded by the total size of its values, in bytes.
+    Entries older than 'ttl' seconds are dropped when they're looked up or when making room.
+    """
+
+    def __init__(self, max_bytes, ttl=None, sizeof=len):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.entries = collections.OrderedDict()  # key -> (value, size, expiry)
+        self.counters = collections.Counter()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        """Whether 'key' is cached and hasn't expired, an expired entry is dropped"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        value, size, expiry = entry
+        if expiry is not None and expiry < time.monotonic():
+            self._remove(key)
+            self.counters['expirations'] += 1
+            return False
+        return True
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.counters['misses'] += 1
+            return default
+        value, size, expiry = entry
+        if expiry is not None and expiry < time.monotonic():
+            self._remove(key)
+            self.counters['expirations'] += 1
+            self.counters['misses'] += 1
+            return default
+        self.entries.move_to_end(key)
+        self.counters['hits'] += 1
+        return value
+
+    def put(self, key, value, size=None):
+        if size is None:
+            size = self.sizeof(value)
+        if key in self.entries:
+            self._remove(key)
+        if size > self.max_bytes:
+            return
+        expiry = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.entries[key] = (value, size, expiry)
+        self.bytes += size
+        self._evict()
+
+    def pop(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        self._remove(key)
+        return entry[0]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def _remove(self, key):
+        value, size, expiry = self.entries.pop(key)
+        self.bytes -= size
+
+    def _evict(self):
+        now = time.monotonic()
+        for key, (value, size, expiry) in list(self.entries.items()):
+            if expiry is not None and expiry < now:
+                self._remove(key)
+                self.counters['expirations'] += 1
+        while self.bytes > self.max_bytes:
+            key = next(iter(self.entries))
+            self._remove(key)
+            self.counters['evictions'] += 1
+
+    def stats(self):
+        lookups = self.counters['hits'] + self.counters['misses']
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.counters['hits'],
+            'misses': self.counters['misses'],
+            'evictions': self.counters['evictions'],
+            'expirations': self.counters['expirations'],
+            'hit_rate': self.counters['hits'] / lookups if lookups else 0.0,
+        }
+
+
+class SingleFlightCache:
+    """
+    Wraps an LRUCache so that concurrent lookups of the same missing key share a single
+    computation of its value instead of starting one each.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.in_flight = {}
+        self.counters = collections.Counter()
+
+    def __contains__(self, key):
+        """Whether 'key' is cached and unexpired, or being computed"""
+        return key in self.cache or key in self.in_flight
+
+    async def get(self, key, create):
+        """Returns the cached value for 'key', awaiting 'create()' to make it if it's missing"""
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.counters['joined'] += 1
+            return await asyncio.shield(future)
+        future = self.in_flight[key] = asyncio.get_event_loop().create_future()
+        try:
+            value = await create()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # whoever joined gets it, don't warn about it never being retrieved
+                future.exception()
+            raise
+        else:
+            future.set_result(value)
+            self.cache.put(key, value)
+            return value
+        finally:
+            del self.in_flight[key]
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats['joined'] = self.counters['joined']
+        stats['in_flight'] = len(self.in_flight)
+        return stats
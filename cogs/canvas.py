@@ -0,0 +1,61 @@
+from .lut import apply_tables, has_grayscale
+
+
+class Canvas:
+    """
+    An image going through a chain of operations.
+    While the operations only need the colors, its alpha band is kept apart and its colors stay RGB
+    (or L once grayscale), so they aren't split off, converted and put back together at every step.
+    The image is only put together when an operation needs all of it, or at the end.
+    """
+
+    def __init__(self, image):
+        self._image = image
+        # set while the alpha is kept apart
+        self._color = None
+        self._alpha = None
+        # whether the image will have alpha once put together even if it had none, like grayscale results
+        self._opaque_alpha = False
+
+    def _detach(self):
+        if self._color is not None:
+            return
+        try:
+            self._alpha = self._image.getchannel('A')
+        except ValueError:
+            self._alpha = None
+        self._color = self._image.convert("RGB")
+        self._image = None
+        self._opaque_alpha = False
+
+    def point(self, steps):
+        """Applies the pointwise 'steps' of cogs.lut to the colors"""
+        self._detach()
+        self._color = apply_tables(self._color, steps)
+        if has_grayscale(steps):
+            self._opaque_alpha = True
+
+    def each_band(self, operation, *args):
+        """Applies 'operation', which does the same to every band on its own, like a flip"""
+        if self._color is None:
+            self._image = operation(self._image, *args)
+            return
+        self._color = operation(self._color, *args)
+        if self._alpha is not None:
+            self._alpha = operation(self._alpha, *args)
+
+    def image(self):
+        """The whole image, as it would be had every operation been applied to it on its own"""
+        if self._color is not None:
+            image = self._color
+            if image.mode == 'L' or self._opaque_alpha:
+                image = image.convert("RGBA")
+            if self._alpha is not None:
+                # converts to RGBA in place
+                image.putalpha(self._alpha)
+            self._image, self._color, self._alpha = image, None, None
+        return self._image
+
+    def apply(self, operation, *args):
+        """Applies 'operation' to the whole image"""
+        self._image = operation(self.image(), *args)
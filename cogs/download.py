@@ -0,0 +1,140 @@
+import aiohttp
+import asyncio
+import collections
+import os
+import urllib.parse
+
+
+# uploads bigger than this are never downloaded whole, still images are fetched downscaled instead
+DOWNLOAD_MAX_BYTES = int(os.environ.get('DOWNLOAD_MAX_BYTES', 8 * 2**20))
+# uploads are refused before being downloaded if Discord says they have more pixels than this
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 25 * 10**6))
+CHUNK_SIZE = 64 * 1024
+# seconds to wait for Discord to say whether a file is still there
+EXISTS_TIMEOUT = float(os.environ.get('EXISTS_TIMEOUT', 5))
+# enough of the start of a file to recognize its format
+SNIFF_BYTES = 12
+# Discord's media proxy can only be trusted to downscale still images
+PROXY_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+class DownloadError(Exception):
+    """The upload wasn't downloaded, with a message for the user"""
+
+
+class ImageGone(DownloadError):
+    """The upload isn't there anymore, its message was deleted"""
+
+
+def sniff_format(data):
+    """The Pillow format name of the file starting with 'data', or None if it isn't an image we take"""
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'PNG'
+    if data[:3] == b'\xff\xd8\xff':
+        return 'JPEG'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'GIF'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+
+def add_query(url, **params):
+    """'url' with 'params' added after the query it already has, which is left as it is"""
+    parts = urllib.parse.urlsplit(url)
+    # Discord's signed links end their query with a '&'
+    query = '&'.join(filter(None, (parts.query.rstrip('&'), urllib.parse.urlencode(params))))
+    return urllib.parse.urlunsplit(parts._replace(query=query))
+
+
+class Downloader:
+    """
+    Downloads uploads, deciding from what Discord says about them whether they're worth it first.
+    Downloads are streamed and stopped as soon as they're over 'max_bytes' or don't start like an image,
+    so unusable uploads cost next to nothing.
+    """
+
+    def __init__(self, max_bytes=DOWNLOAD_MAX_BYTES, max_pixels=IMAGE_MAX_PIXELS):
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self._session = None
+        self.counters = collections.Counter()
+
+    @property
+    def session(self):
+        # created lazily so it belongs to the running event loop
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60))
+        return self._session
+
+    def plan(self, attachment, shrunk_size=None):
+        """
+        Returns the URL to download 'attachment' from, or raises DownloadError if it can't be used
+        Still images too big to download whole are asked to Discord's media proxy at 'shrunk_size' instead
+        """
+        pixels = (attachment.width or 0) * (attachment.height or 0)
+        if attachment.size <= self.max_bytes and pixels <= self.max_pixels:
+            return attachment.url
+        if attachment.width and attachment.height and attachment.filename.lower().endswith(PROXY_EXTENSIONS):
+            width, height = shrunk_size or (attachment.width, attachment.height)
+            self.counters['proxied'] += 1
+            return add_query(attachment.proxy_url, width=width, height=height)
+        self.counters['refused'] += 1
+        if pixels > self.max_pixels:
+            raise DownloadError("That image has too many pixels.")
+        raise DownloadError(f"That image is too big, it can't be over {self.max_bytes // 2**20}MB.")
+
+    async def fetch(self, url):
+        """
+        Downloads 'url', raising DownloadError once it's too big or isn't an image, or if it can't be downloaded
+        ImageGone is raised if it doesn't exist anymore
+        """
+        try:
+            return await self._fetch(url)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.counters['failed'] += 1
+            raise DownloadError("Couldn't download the image.")
+
+    async def _fetch(self, url):
+        async with self.session.get(url) as response:
+            if response.status == 404:
+                raise ImageGone("The image doesn't exist anymore.")
+            if response.status >= 400:
+                self.counters['failed'] += 1
+                raise DownloadError("Couldn't download the image.")
+            if response.content_length is not None and response.content_length > self.max_bytes:
+                self.counters['refused'] += 1
+                raise DownloadError("That image is too big.")
+            data = bytearray()
+            sniffed = False
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                data += chunk
+                if len(data) > self.max_bytes:
+                    self.counters['stopped'] += 1
+                    raise DownloadError("That image is too big.")
+                if not sniffed and len(data) >= SNIFF_BYTES:
+                    self._check_format(data)
+                    sniffed = True
+            if not sniffed:
+                self._check_format(data)
+        self.counters['downloaded'] += 1
+        self.counters['bytes'] += len(data)
+        return bytes(data)
+
+    async def exists(self, url):
+        """Whether 'url' can still be downloaded, only asking for its headers"""
+        try:
+            async with self.session.head(url, timeout=aiohttp.ClientTimeout(total=EXISTS_TIMEOUT)) as response:
+                return response.status < 400
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    def _check_format(self, data):
+        if sniff_format(data) is None:
+            self.counters['stopped'] += 1
+            raise DownloadError("That doesn't look like an image.")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
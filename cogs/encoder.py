@@ -0,0 +1,115 @@
+import io
+import os
+import time
+from PIL import GifImagePlugin, Image, features
+from .image_handling import Encoded
+
+
+# results bigger than this many bytes are re-encoded smaller, it defaults to Discord's upload limit
+UPLOAD_LIMIT = int(os.environ.get('UPLOAD_LIMIT', 8 * 2**20))
+# images with at most this many colors are drawings, logos or text, which PNG handles best
+FEW_COLORS = 256
+LOSSY_QUALITIES = (90, 75, 60, 45)
+WEBP = features.check('webp')
+# ends a GIF after its header and frames
+GIF_TRAILER = b';'
+
+
+def has_alpha(image):
+    """Whether some pixel of 'image' isn't fully opaque"""
+    if image.mode == 'P':
+        return 'transparency' in image.info
+    if image.mode not in ('RGBA', 'LA'):
+        return False
+    return image.getchannel('A').getextrema()[0] < 255
+
+
+def _save(image, format, counters, **params):
+    start = time.perf_counter()
+    with io.BytesIO() as f:
+        image.save(f, format=format, **params)
+        data = f.getvalue()
+    name = format.lower()
+    counters[f'encode_{name}_count'] += 1
+    counters[f'encode_{name}_seconds'] += time.perf_counter() - start
+    counters[f'encode_{name}_bytes'] += len(data)
+    return Encoded(data, format)
+
+
+def _attempts(image):
+    """The ways to encode 'image' to try, from the best looking to the smallest"""
+    alpha = has_alpha(image)
+    few_colors = image.getcolors(FEW_COLORS) is not None
+    if few_colors or (alpha and not WEBP):
+        yield 'PNG', {'compress_level': 3}
+    if alpha:
+        if WEBP:
+            yield 'WEBP', {'lossless': True, 'method': 1, 'quality': 20}
+            for quality in LOSSY_QUALITIES:
+                yield 'WEBP', {'quality': quality, 'method': 2}
+    else:
+        for quality in LOSSY_QUALITIES:
+            yield 'JPEG', {'quality': quality}
+
+
+def _prepare(image, format):
+    if format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        return image.convert('RGB')
+    if format == 'WEBP' and image.mode not in ('RGB', 'RGBA'):
+        return image.convert('RGBA')
+    return image
+
+
+def encode(image, counters, budget=UPLOAD_LIMIT):
+    """
+    Encodes 'image' as PNG, WebP or JPEG depending on its content, trying smaller encodings
+    and then smaller sizes until it fits in 'budget' bytes.
+    How long each format took and how big it got is added to 'counters'.
+    """
+    encoded = None
+    for format, params in _attempts(image):
+        encoded = _save(_prepare(image, format), format, counters, **params)
+        if len(encoded.data) <= budget:
+            return encoded
+        counters['encode_retries'] += 1
+    # even the smallest encoding is too big, so shrink the image about as much as it's over budget
+    while len(encoded.data) > budget and image.width >= 16 and image.height >= 16:
+        scale = max(0.5, min(0.9, (budget / len(encoded.data)) ** 0.5))
+        image = image.resize((int(image.width * scale), int(image.height * scale)), resample=Image.LANCZOS)
+        counters['encode_downscales'] += 1
+        encoded = _save(_prepare(image, format), format, counters, **params)
+    return encoded
+
+
+def gif_header(size, loop=None):
+    """The start of an animated GIF of 'size' frames, playing 'loop' times or once if it's None"""
+    canvas = Image.new('P', size)
+    # frames have a graphic control extension, which needs the 89a version
+    canvas.info['version'] = b'89a'
+    info = {} if loop is None else {'loop': loop}
+    header, _ = GifImagePlugin.getheader(canvas, info=info)
+    return b''.join(header)
+
+
+def gif_frame(image, duration, counters):
+    """
+    Encodes 'image' as one frame of an animated GIF, shown for 'duration' milliseconds.
+    Every frame has its own palette, pixels that are mostly transparent become fully transparent.
+    """
+    start = time.perf_counter()
+    image = image.convert('RGBA')
+    transparent = image.getchannel('A').point(lambda a: 255 if a < 128 else 0)
+    alpha = transparent.getbbox() is not None
+    # the last palette index is kept for transparency
+    frame = image.convert('RGB').quantize(255 if alpha else 256, method=Image.FASTOCTREE)
+    params = {'duration': duration, 'disposal': 2, 'include_color_table': True}
+    if alpha:
+        palette = frame.getpalette()
+        frame.putpalette(palette + [0] * (768 - len(palette)))
+        frame.paste(255, mask=transparent)
+        params['transparency'] = 255
+    data = b''.join(GifImagePlugin.getdata(frame, **params))
+    counters['encode_gif_count'] += 1
+    counters['encode_gif_seconds'] += time.perf_counter() - start
+    counters['encode_gif_bytes'] += len(data)
+    return data
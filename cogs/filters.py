@@ -1,37 +1,9 @@
-from PIL import Image, ImageFilter, ImageOps, ImageEnhance, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageFilter, ImageOps, ImageEnhance
 from discord.ext import commands
-from .image_handling import get_image, send_image
-
-
-def wrap_line(draw, font, line, width):
-    # check if line already fits
-    size = draw.textsize(line, font)
-    if size[0] < width:
-        return line, ""
-    space = line.find(' ', 0)
-    if space == -1:  # There's only one word
-        return line, ""
-    # the first 'previous space', is the first space
-    prev_space = space
-    while space != -1:
-        size = draw.textsize(line[:space], font=font)
-        if size[0] >= width:
-            return line[:prev_space], line[prev_space + 1:]
-        prev_space = space
-        space = line.find(' ', prev_space + 1)
-    return line[:prev_space], line[prev_space + 1:]
-
-
-def wrap_text(draw, font, text, width):
-    result = ""
-    for remaining_line in text.splitlines():
-        if not remaining_line:
-            result += "\n"
-        while remaining_line:
-            line, remaining_line = wrap_line(draw, font, remaining_line, width)
-            result += line
-            result += '\n'
-    return result.rstrip()
+from .image_handling import get_image, process_image
+from .text import draw_caption
+from .lut import apply_pointwise
+from .batch import run_batch
 
 
 def blur(image):
@@ -39,15 +11,7 @@ def blur(image):
 
 
 def invert(image):
-    try:
-        alpha = image.getchannel('A')
-    except ValueError:
-        alpha = None
-    image = image.convert("RGB")
-    image = ImageOps.invert(image)
-    if alpha:
-        image.putalpha(alpha)
-    return image
+    return apply_pointwise(image, (('invert',),))
 
 
 def flipv(image):
@@ -68,11 +32,11 @@ def symm(image, side='left'):
         crop = image.crop((round(w / 2 + 0.1), 0, w, h))
         crop = ImageOps.mirror(crop)
         image.paste(crop, (0, 0))
-    elif side == 'up':
+    elif side == 'top':
         crop = image.crop((0, 0, w, h // 2))
         crop = ImageOps.flip(crop)
         image.paste(crop, (0, round(h / 2 + 0.1)))
-    elif side == 'down':
+    elif side == 'bottom':
         crop = image.crop((0, round(h / 2 + 0.1), w, h))
         crop = ImageOps.flip(crop)
         image.paste(crop, (0, 0))
@@ -80,15 +44,7 @@ def symm(image, side='left'):
 
 
 def posterize(image):
-    try:
-        alpha = image.getchannel('A')
-    except ValueError:
-        alpha = None
-    image = image.convert("RGB")
-    image = ImageOps.posterize(image, 2)
-    if alpha:
-        image.putalpha(alpha)
-    return image
+    return apply_pointwise(image, (('posterize',),))
 
 
 def shrink(image, per=5):
@@ -105,14 +61,7 @@ def glitch(image):
     image = image.resize((int(w ** .88), int(h ** .88)), resample=Image.BILINEAR)
     image = image.resize((int(w ** .9), int(h ** .9)), resample=Image.BICUBIC)
     image = image.resize((w, h), resample=Image.BICUBIC)
-    try:
-        alpha = image.getchannel('A')
-    except ValueError:
-        alpha = None
-    image = image.convert("RGB")
-    image = ImageOps.posterize(image, 4)
-    if alpha:
-        image.putalpha(alpha)
+    image = apply_pointwise(image, (('posterize', 4),))
     image = ImageEnhance.Sharpness(image).enhance(100.0)
     return image
 
@@ -141,30 +90,43 @@ def rotate(image, rotation='right'):
 
 
 def transparent(image):
+    """Makes grayish pixels as transparent as they are bright, keeping alpha if it was lower already"""
     image = image.convert("RGBA")
-    alpha = image.getchannel('A')
-    p = 0
-    for (r, g, b, a) in image.getdata():
-        if abs(r-g) + abs(g-b) < 10:
-            x = p % alpha.width
-            y = p // alpha.width
-            if a > 255 - min(r, g, b):
-                alpha.putpixel((x, y), 255 - min(r, g, b))
-        p += 1
+    r, g, b, alpha = image.split()
+    # pixels are grayish when abs(r-g) + abs(g-b) < 10
+    saturation = ImageChops.add(ImageChops.difference(r, g), ImageChops.difference(g, b))
+    grayish = saturation.point(lambda v: 255 if v < 10 else 0)
+    brightness = ImageChops.invert(ImageChops.darker(ImageChops.darker(r, g), b))
+    alpha = Image.composite(ImageChops.darker(alpha, brightness), alpha, grayish)
     image.putalpha(alpha)
     return image
 
 
 def grayscale(image):
-    try:
-        alpha = image.getchannel('A')
-    except ValueError:
-        alpha = None
-    image = ImageOps.grayscale(image)
+    return apply_pointwise(image, (('grayscale',),))
+
+
+def brightness(image, percent=150):
+    return apply_pointwise(image, (('brightness', percent),))
+
+
+def contrast(image, percent=150):
+    return apply_pointwise(image, (('contrast', percent),))
+
+
+def threshold(image, level=128):
+    return apply_pointwise(image, (('threshold', level),))
+
+
+def gamma(image, value=2.2):
+    return apply_pointwise(image, (('gamma', value),))
+
+
+def impact(image, top, bottom=''):
+    """Meme captions, 'top' above and 'bottom' below"""
     image = image.convert("RGBA")
-    if alpha:
-        image.putalpha(alpha)
-    return image
+    image = draw_caption(image, top, 'top')
+    return draw_caption(image, bottom, 'bottom')
 
 
 filters = {
@@ -183,6 +145,10 @@ advanced_filters = {
     'symm': symm,
     'shrink': shrink,
     'rotate': rotate,
+    'brightness': brightness,
+    'contrast': contrast,
+    'threshold': threshold,
+    'gamma': gamma,
 }
 
 
@@ -193,17 +159,18 @@ class Filters(commands.Cog):
 
 
     @commands.command(aliases=list(filters))
-    async def filter(self, ctx):
+    async def filter(self, ctx, *flags):
+        """Use '--all', '--last N' and '--sheet' for several images."""
         filter_name = ctx.invoked_with
         if filter_name == 'filter':
             return
+        if await run_batch(ctx, flags, [(filter_name,)]):
+            return
         image, image_message = await get_image(ctx)
         if not image:
             return
 
-        image = filters[filter_name](image)
-
-        await send_image(ctx, image, image_message)
+        await process_image(ctx, image, image_message, [(filter_name,)])
 
 
     @commands.command()
@@ -215,25 +182,7 @@ class Filters(commands.Cog):
         if not image:
             return
 
-        w, h = image.size
-        if side == 'left':
-            crop = image.crop((0, 0, w//2, h))
-            crop = ImageOps.mirror(crop)
-            image.paste(crop, (round(w / 2 + 0.1), 0))
-        elif side == 'right':
-            crop = image.crop((round(w / 2 + 0.1), 0, w, h))
-            crop = ImageOps.mirror(crop)
-            image.paste(crop, (0, 0))
-        elif side == 'top':
-            crop = image.crop((0, 0, w, h//2))
-            crop = ImageOps.flip(crop)
-            image.paste(crop, (0, round(h / 2 + 0.1)))
-        elif side == 'bottom':
-            crop = image.crop((0, round(h / 2 + 0.1), w, h))
-            crop = ImageOps.flip(crop)
-            image.paste(crop, (0, 0))
-
-        await send_image(ctx, image, image_message)
+        await process_image(ctx, image, image_message, [('symm', side)])
 
 
     @commands.command()
@@ -243,12 +192,8 @@ class Filters(commands.Cog):
         image, image_message = await get_image(ctx)
         if not image:
             return
-        image = image.convert("RGBA")
-        w = image.width * per // 100
-        h = image.height * per // 100
-        image = image.resize((w, h), resample=Image.LANCZOS)
 
-        await send_image(ctx, image, image_message)
+        await process_image(ctx, image, image_message, [('shrink', per)])
 
 
     @commands.command()
@@ -260,39 +205,52 @@ class Filters(commands.Cog):
         if not image:
             return
 
-        if rotation == 'left':
-            image = image.transpose(Image.ROTATE_90)
-        else:
-            image = image.transpose(Image.ROTATE_270)
+        await process_image(ctx, image, image_message, [('rotate', rotation)])
+
+
+    @commands.command()
+    async def brightness(self, ctx, percent: int = 150):
+        """Makes the last image brighter, or darker under 100%"""
+        await self.color_filter(ctx, 'brightness', percent, 0 <= percent <= 1000, "Percentage must be between 0 and 1000.")
+
+
+    @commands.command()
+    async def contrast(self, ctx, percent: int = 150):
+        """Gives the last image more contrast, or less under 100%"""
+        await self.color_filter(ctx, 'contrast', percent, 0 <= percent <= 1000, "Percentage must be between 0 and 1000.")
+
+
+    @commands.command()
+    async def threshold(self, ctx, level: int = 128):
+        """Turns every channel of the last image fully on above 'level' and off below it"""
+        await self.color_filter(ctx, 'threshold', level, 0 <= level <= 255, "Level must be between 0 and 255.")
+
+
+    @commands.command()
+    async def gamma(self, ctx, value: float = 2.2):
+        """Brightens the midtones of the last image, or darkens them under 1"""
+        await self.color_filter(ctx, 'gamma', value, 0.1 <= value <= 10, "Gamma must be between 0.1 and 10.")
+
+
+    async def color_filter(self, ctx, filter_name, argument, valid, error):
+        if not valid:
+            return await ctx.send(error)
+        image, image_message = await get_image(ctx)
+        if not image:
+            return
 
-        await send_image(ctx, image, image_message)
+        await process_image(ctx, image, image_message, [(filter_name, argument)])
 
 
     @commands.command()
     async def impact(self, ctx, *, text: str):
+        """Captions the last image, text after a '|' goes at the bottom"""
+        top, _, bottom = text.partition('|')
         image, image_message = await get_image(ctx)
         if not image:
             return
 
-        font_size = image.width // 10
-        try:
-            font = ImageFont.truetype(font="fonts/impact.ttf", size=font_size)
-        except IOError:
-            return await ctx.send("Couldn't open the font.")
-        draw = ImageDraw.Draw(image)
-        text = wrap_text(draw, font, text, image.width)
-        text_size = draw.textsize(text, font)
-        x, y = ((image.width - text_size[0]) // 2, 3)
-
-        radius = font_size // 20
-        draw.text((x-radius, y-radius), text, font=font, fill=(0, 0, 0, 255), align="center")
-        draw.text((x-radius, y+radius), text, font=font, fill=(0, 0, 0, 255), align="center")
-        draw.text((x+radius, y-radius), text, font=font, fill=(0, 0, 0, 255), align="center")
-        draw.text((x+radius, y+radius), text, font=font, fill=(0, 0, 0, 255), align="center")
-
-        draw.text((x, y), text, font=font, align="center")
-
-        await send_image(ctx, image, image_message)
+        await process_image(ctx, image, image_message, [('impact', top.strip(), bottom.strip())])
 
 
 def setup(bot):
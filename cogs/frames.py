@@ -1,26 +1,58 @@
-from discord.ext import commands
-from PIL import Image, ImageDraw
-from .image_handling import get_image, send_image, get_frame, get_template
-from .filters import filters, advanced_filters
-import logging
+import collections
+from discord.ext import commands, tasks
+from PIL import Image
+from .image_handling import get_image, send_image, process_image
+from .pipeline import parse_pipe, optimize, explain, PipeError
+from .batch import parse_batch, process_batch, run_batch, BatchError
+
+
+# frames and templates are kept at the size they're uploaded, so template boxes match what users see
+ASSET_MAX_SIZE = None
 
 
 def apply_frame(image, frame):
-    """Modifies image by resizing image to its size and pasting it"""
-    frame = frame.resize(image.size, Image.LANCZOS)
+    """Modifies image by resizing frame to its size and pasting it"""
+    if frame.size != image.size:
+        frame = frame.resize(image.size, Image.LANCZOS)
     image.paste(frame, (0, 0), frame)
     return image
 
 
-def apply_template(image, template, box):
-    """Modifies template by inserting image in box part of template"""
-    box_size = (box[2]-box[0], box[3]-box[1])
-    image = image.resize(box_size, Image.LANCZOS)
-    template_crop = template.crop(box)
-    template.paste(image, box)
-    # we also paste the template over itself so the image is behind it
-    template.paste(template_crop, box, template_crop)
-    return template
+# the template as the background, and for each box what's left of the template over the image
+# as (image, position), or None if the box is a hole with nothing over it
+TemplateLayers = collections.namedtuple('TemplateLayers', 'background boxes overlays')
+
+
+def template_layers(template, boxes):
+    """Precomputes what apply_template needs from 'template' with images in 'boxes'"""
+    background = template.convert('RGBA')
+    overlays = []
+    for box in boxes:
+        crop = background.crop(box)
+        # only the part of the box the template doesn't leave transparent has to be composited
+        visible = crop.getchannel('A').getbbox()
+        if visible is None:
+            overlays.append(None)
+        else:
+            overlays.append((crop.crop(visible), (box[0] + visible[0], box[1] + visible[1])))
+    return TemplateLayers(background, tuple(boxes), overlays)
+
+
+def apply_template(image, layers):
+    """Returns a copy of the template of 'layers' with image inserted behind it in each of its boxes"""
+    result = layers.background.copy()
+    if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        image = image.convert('RGBA')
+    resized = {}
+    for box, overlay in zip(layers.boxes, layers.overlays):
+        box_size = (box[2] - box[0], box[3] - box[1])
+        if box_size not in resized:
+            # resizing before converting works on less channels when the image has no alpha
+            resized[box_size] = image.resize(box_size, Image.LANCZOS).convert('RGBA')
+        result.paste(resized[box_size], box[:2])
+        if overlay is not None:
+            result.alpha_composite(*overlay)
+    return result
 
 
 def detect_template(image):
@@ -31,92 +63,89 @@ def detect_template(image):
     :return: An (int, int, int, int) tuple or None.
     """
     try:
-        image = image.getchannel('A')
+        alpha = image.getchannel('A')
     except ValueError:
         return None
-    x1 = image.width
-    y1 = image.height
-    x2 = 0
-    y2 = 0
-    i = 0
-    for pixel in image.getdata():
-        if pixel != 255:
-            x = i % image.width
-            y = i // image.width
-            if x < x1:
-                x1 = x
-            if y < y1:
-                y1 = y
-            if x > x2:
-                x2 = x
-            if y > y2:
-                y2 = y
-        i += 1
-    return x1, y1, x2, y2
+    box = alpha.point(lambda v: 0 if v == 255 else 255).getbbox()
+    if box is None:
+        # there's no transparency at all
+        return image.width, image.height, 0, 0
+    x1, y1, x2, y2 = box
+    return x1, y1, x2 - 1, y2 - 1
 
 
-class Frames(commands.Cog):
+def parse_boxes(coordinates):
+    """Groups 'coordinates' in (x1, y1, x2, y2) boxes, or returns None if they don't make valid boxes"""
+    if not coordinates or len(coordinates) % 4:
+        return None
+    boxes = tuple(tuple(coordinates[i:i + 4]) for i in range(0, len(coordinates), 4))
+    for x1, y1, x2, y2 in boxes:
+        if x1 >= x2 or y1 >= y2 or x1 < 0 or y1 < 0:
+            return None
+    return boxes
 
-    try:
-        with open("frames/frames.txt") as f:
-            frames = f.read().split()
-    except FileNotFoundError:
-        logging.warning("Couldn't find frames/frames.txt.")
-        frames = []
 
-    try:
-        templates = {}
-        with open("frames/templates.txt") as f:
-            for line in f:
-                template, *coords = line.split()
-                try:
-                    x1, y1, x2, y2 = [int(x) for x in coords]
-                except ValueError as e:
-                    logging.warning(e)
-                else:
-                    templates[template] = (x1, y1, x2, y2)
-    except FileNotFoundError:
-        logging.warning("Couldn't find frames/templates.txt")
-        templates = {}
+def boxes_fit(boxes, width, height):
+    return all(x2 <= width and y2 <= height for x1, y1, x2, y2 in boxes)
+
+
+def describe_boxes(boxes):
+    return ('box ' if len(boxes) == 1 else 'boxes ') + ', '.join(str(box) for box in boxes)
+
+
+class Frames(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
+        self.registry = bot.asset_registry
+        # registered when the cog is added, later changes add and remove aliases as they happen
+        self.frame.aliases = self.registry.names('frame')
+        self.template.aliases = self.registry.names('template')
+        self.watch_assets.start()
+
 
+    def cog_unload(self):
+        self.watch_assets.cancel()
 
-    @commands.command(aliases=frames.copy())
-    async def frame(self, ctx):
-        """Paste the frame on the last image."""
-        frame_name = ctx.invoked_with
-        if frame_name == 'frame':
+
+    @tasks.loop(seconds=2)
+    async def watch_assets(self):
+        """Picks up frames and templates changed by the other processes of a cluster, see cluster.py"""
+        changes = await self.registry.reload_if_changed()
+        if changes:
+            self.sync_aliases(*changes)
+
+
+    @commands.command()
+    async def frame(self, ctx, *flags):
+        """Paste the frame on the last image. Use '--all', '--last N' and '--sheet' for several images."""
+        frame = self.registry.get(ctx.invoked_with, 'frame')
+        if frame is None:
+            return
+        operations = [('frame', frame.name, frame.version)]
+        if await run_batch(ctx, flags, operations):
             return
         image, image_message = await get_image(ctx)
         if not image:
             return
-        frame = get_frame(frame_name)
-        if not frame:
-            return await ctx.send(f"Couldn't open frame '{frame_name}'.")
-
-        image = apply_frame(image, frame)
 
-        await send_image(ctx, image, image_message)
+        await process_image(ctx, image, image_message, operations)
 
 
-    @commands.command(aliases=list(templates))
-    async def template(self, ctx):
-        """Insert the last image in the template."""
-        template_name = ctx.invoked_with
-        if template_name == 'template':
+    @commands.command()
+    async def template(self, ctx, *flags):
+        """Insert the last image in the template. Use '--all', '--last N' and '--sheet' for several images."""
+        template = self.registry.get(ctx.invoked_with, 'template')
+        if template is None:
+            return
+        operations = [('template', template.name, template.version, template.boxes)]
+        if await run_batch(ctx, flags, operations):
             return
         image, image_message = await get_image(ctx)
         if not image:
             return
-        template = get_template(template_name)
-        if not template:
-            return await ctx.send(f"Couldn't open template '{template_name}'.")
-
-        image = apply_template(image, template, Frames.templates[template_name])
 
-        await send_image(ctx, image, image_message)
+        await process_image(ctx, image, image_message, operations)
 
 
     @commands.command()
@@ -127,30 +156,17 @@ class Frames(commands.Cog):
             return
 
         try:
-            test_image.convert("RGBA").save("frames/testframe.png")
+            size = await self.save_image(test_image, 'testframe')
+            await self.registry.add('testframe', 'frame', size)
         except IOError:
             return await ctx.send("Image couldn't be saved.")
         return await ctx.send("Changed test frame")
 
 
     @commands.command()
-    async def addtesttemplate(self, ctx, x1: int, y1: int, x2: int, y2: int):
-        """Download the last image and add it as a test template."""
-        if x1 >= x2 or y1 >= y2 or x1 < 0 or y1 < 0:
-            return await ctx.send("Those coordinates don't seem valid.")
-
-        test_image, image_message = await get_image(ctx)
-        if not test_image:
-            return
-        if test_image.width < x2 or test_image.height < y2:
-            return await ctx.send("Box goes outside of template.")
-
-        try:
-            test_image.convert("RGBA").save("frames/testtemplate.png")
-            Frames.templates['testtemplate'] = (x1, y1, x2, y2)
-        except IOError:
-            return await ctx.send("Image couldn't be saved.")
-        return await ctx.send("Changed test template.")
+    async def addtesttemplate(self, ctx, *coordinates: int):
+        """Download the last image and add it as a test template, with the transparent box if no boxes are given."""
+        await self.add_template(ctx, 'testtemplate', coordinates)
 
 
     @commands.command(name="addframe")
@@ -162,127 +178,82 @@ class Frames(commands.Cog):
         if not frame:
             return
         try:
-            frame.convert('RGBA').save(f'frames/{frame_name}.png')
+            size = await self.save_image(frame, frame_name)
+            await self.registry.add(frame_name, 'frame', size)
         except IOError:
             return await ctx.send("Couldn't save the image.")
 
-        with open('frames/frames.txt', 'a') as f:
-            f.write(f'\n{frame_name}')
-        command = self.bot.get_command('frame')
-        command.aliases.append(frame_name)
-        self.frames.append(frame_name)
-        self.bot.all_commands[frame_name] = command
+        self.add_alias('frame', frame_name)
         await ctx.send(f"Added frame {frame_name}.")
 
 
     @commands.command(name="removeframe")
     async def _remove_frame(self, ctx, frame_name: str):
         """Remove a frame."""
-        if frame_name not in self.frames:
+        if not self.registry.get(frame_name, 'frame'):
             return await ctx.send("There's no frame with that name.")
-        self.frames.remove(frame_name)
+        await self.registry.remove(frame_name)
         self.bot.remove_command(frame_name)
-        with open('frames/frames.txt', 'w') as f:
-            f.write('\n'.join(self.frames))
         await ctx.send(f"Removed frame {frame_name}.")
 
 
     @commands.command(name="removetemplate")
     async def _remove_template(self, ctx, template_name: str):
         """Remove a template."""
-        if template_name not in self.templates:
+        if not self.registry.get(template_name, 'template'):
             return await ctx.send("There's no template with that name.")
-        del self.templates[template_name]
+        await self.registry.remove(template_name)
         self.bot.remove_command(template_name)
-        with open('frames/templates.txt', 'w') as f:
-            first_template = True
-            for template, coordinates in self.templates.items():
-                x1, y1, x2, y2 = coordinates
-                if first_template:
-                    f.write(f'{template} {x1} {y1} {x2} {y2}')
-                    first_template = False
-                else:
-                    f.write(f'\n{template} {x1} {y1} {x2} {y2}')
         await ctx.send(f"Removed template {template_name}.")
 
 
     @commands.command(name="movetemplate")
-    async def move_template(self, ctx, template_name: str, x1: int, y1: int, x2: int, y2: int):
-        """Move a template's rectangle to (x1, y1, x2, y2)."""
-        if template_name not in self.templates:
+    async def move_template(self, ctx, template_name: str, *coordinates: int):
+        """Move a template's rectangle to (x1, y1, x2, y2), more coordinates add more boxes."""
+        template = self.registry.get(template_name, 'template')
+        if template is None:
             return await ctx.send("There's no template with that name.")
-        if x1 >= x2 or y1 >= y2 or x1 < 0 or y1 < 0:
+        boxes = parse_boxes(coordinates)
+        if boxes is None:
             return await ctx.send("Those coordinates don't seem valid.")
-        
-        template = get_template(template_name)
-        if not template:
-            return await ctx.send(f"Couldn't open template '{template_name}'.")
-        if template.width < x2 or template.height < y2:
+        if not boxes_fit(boxes, template.width, template.height):
             return await ctx.send("Box goes outside of template.")
-        
-        self.templates[template_name] = (x1, y1, x2, y2)
-
-        with open('frames/templates.txt', 'w') as f:
-            first_template = True
-            for template, coordinates in self.templates.items():
-                x1, y1, x2, y2 = coordinates
-                if first_template:
-                    f.write(f'{template} {x1} {y1} {x2} {y2}')
-                    first_template = False
-                else:
-                    f.write(f'\n{template} {x1} {y1} {x2} {y2}')
-        await ctx.send(f"Moved template box of {template_name} to ({x1}, {y1}, {x2}, {y2}).")
-    
+
+        await self.registry.move(template_name, boxes)
+        await ctx.send(f"Moved template {template_name} to {describe_boxes(boxes)}.")
+
 
     @commands.command(name="addtemplate")
-    async def _add_template(self, ctx, template_name: str, x1: int, y1: int, x2: int, y2: int):
-        """Download the last image and add it as a template with rectangle (x1, y1, x2, y2)."""
+    async def _add_template(self, ctx, template_name: str, *coordinates: int):
+        """
+        Download the last image and add it as a template with rectangle (x1, y1, x2, y2).
+        More coordinates add more boxes, with none its transparent box is detected.
+        """
         if self.bot.get_command(template_name):
             return await ctx.send("There's already a command with that name.")
-        if x1 >= x2 or y1 >= y2 or x1 < 0 or y1 < 0:
-            return await ctx.send("Those coordinates don't seem valid.")
-
-        template, template_message = await get_image(ctx)
-        if not template:
-            return
-        if template.width < x2 or template.height < y2:
-            return await ctx.send("Box goes outside of template.")
-
-        try:
-            template.convert('RGBA').save(f'frames/{template_name}.png')
-        except IOError:
-            return await ctx.send("Couldn't save the image.")
-
-        with open('frames/templates.txt', 'a') as f:
-            f.write(f'\n{template_name} {x1} {y1} {x2} {y2}')
-        command = self.bot.get_command('template')
-        command.aliases.append(template_name)
-        Frames.templates[template_name] = (x1, y1, x2, y2)
-        self.bot.all_commands[template_name] = command
-        await ctx.send(f"Added template {template_name} with box ({x1}, {y1}, {x2}, {y2}).")
+        if await self.add_template(ctx, template_name, coordinates):
+            self.add_alias('template', template_name)
 
 
     @commands.command()
-    async def check_template(self, ctx, template_name, x1: int = None, y1: int = None, x2: int = None, y2: int = None):
-        """Draw a rectangle in a template. Rectangle defaults to the template's rectangle."""
-        if template_name not in Frames.templates or template_name == 'template':
+    async def check_template(self, ctx, template_name, *coordinates: int):
+        """Draw the rectangles in a template. Rectangles default to the template's rectangles."""
+        template = self.registry.get(template_name, 'template')
+        if template is None:
             return await ctx.send("There's no template with that name.")
-        if x1 is not None:
-            if y2 is None:
-                return await ctx.send("Coordinates are partial and not valid.")
-            elif x1 >= x2 or y1 >= y2 or x1 < 0 or y1 < 0:
+        boxes = template.boxes
+        if coordinates:
+            boxes = parse_boxes(coordinates)
+            if boxes is None:
                 return await ctx.send("Those coordinates don't seem valid.")
-        else:
-            x1, y1, x2, y2 = Frames.templates[template_name]
 
-        template = get_template(template_name)
-        if not template:
+        try:
+            encoded = await self.bot.render_engine.render(
+                self.registry.image_path(template_name), [('outline', box) for box in boxes])
+        except IOError:
             return await ctx.send(f"Couldn't open template '{template_name}'.")
 
-        draw = ImageDraw.Draw(template)
-        draw.rectangle((x1, y1, x2, y2), outline=(255, 0, 0, 255), width=2)
-
-        await send_image(ctx, template, ctx.message)
+        await send_image(ctx, encoded, ctx.message)
 
 
     @commands.command(name="detecttemplate")
@@ -291,85 +262,112 @@ class Frames(commands.Cog):
         image, image_message = await get_image(ctx)
         if not image:
             return
-        coords = detect_template(image)
+        try:
+            coords, encoded = await self.bot.render_engine.detect(image, ASSET_MAX_SIZE)
+        except IOError:
+            return await ctx.send("Last image isn't valid.")
         if coords is None:
             return await ctx.send("That image doesn't have an alpha channel.")
-        draw = ImageDraw.Draw(image)
-        draw.rectangle(coords, outline=(255, 0, 0, 255), width=2)
-        await send_image(ctx, image, ctx.message)
+        await send_image(ctx, encoded, ctx.message)
         await ctx.send(str(coords))
 
 
     @commands.command()
     async def pipe(self, ctx, *, pipe_string: str):
-        """Performs a series of frames and templates on an image"""
-        command_list = pipe_string.split()
-        advanced_filter_command = None
-        for command_name in command_list:
-            if advanced_filter_command:
-                if advanced_filter_command == 'symm':
-                    side = command_name.lower()
-                    if side not in ('left', 'right', 'top', 'bottom'):
-                        return await ctx.send("Valid sides are 'left', 'right', 'top', and 'bottom'.")
-                elif advanced_filter_command == 'shrink':
-                    try:
-                        per = int(command_name)
-                    except ValueError:
-                        return await ctx.send("The percentage to shrink must be a number.")
-                    if not (1 <= per <= 99):
-                        return await ctx.send("Percentage must be between 1 and 99.")
-                elif advanced_filter_command == 'rotate':
-                    rotation = command_name.lower()
-                    if rotation not in ('left', 'right'):
-                        return await ctx.send("Rotation must be 'left' or 'right'.")
-                advanced_filter_command = None
-            elif command_name in Frames.frames:
-                continue
-            elif command_name in Frames.templates:
-                continue
-            elif command_name in filters:
-                continue
-            elif command_name in advanced_filters:
-                advanced_filter_command = command_name
-                continue
-            else:
-                return await ctx.send(f"{command_name} is not a frame or a template or a filter.")
+        """
+        Performs a series of frames and templates on an image. Start with 'explain' to see the plan.
+        Use '--all', '--last N' and '--sheet' for several images.
+        """
+        words = pipe_string.split(maxsplit=1)
+        explaining = words[0].lower() == 'explain'
+        if explaining:
+            pipe_string = words[1] if len(words) > 1 else ''
+        try:
+            batch, words = parse_batch(pipe_string.split())
+            operations = parse_pipe(' '.join(words), self.registry.assets)
+        except (BatchError, PipeError) as e:
+            return await ctx.send(str(e))
+        plan = optimize(tuple(operations))
+        if explaining:
+            return await ctx.send(explain(operations, plan))
+        if batch is not None:
+            return await process_batch(ctx, batch, plan)
+
         image, image_message = await get_image(ctx)
         if not image:
             return
+        await process_image(ctx, image, image_message, plan)
+
+
+    @commands.command()
+    async def reloadassets(self, ctx):
+        """Reads the frames and templates again, for changes made while the bot was running."""
+        added, removed = await self.registry.reload()
+        for name in self.sync_aliases(added, removed):
+            await ctx.send(f"Skipped {name}, there's already a command with that name.")
+        await ctx.send(f"Reloaded assets, {len(added)} added and {len(removed)} removed.")
+
+
+    async def add_template(self, ctx, template_name, coordinates):
+        """Saves the last image as the template 'template_name', returns whether it was added"""
+        boxes = None
+        if coordinates:
+            boxes = parse_boxes(coordinates)
+            if boxes is None:
+                await ctx.send("Those coordinates don't seem valid.")
+                return False
+
+        template, template_message = await get_image(ctx)
+        if not template:
+            return False
+        # checked before saving, so nothing is left behind for templates that aren't added
+        try:
+            width, height = await self.bot.render_engine.measure(template, ASSET_MAX_SIZE)
+            if boxes is None:
+                boxes = parse_boxes(await self.bot.render_engine.detect_box(template, ASSET_MAX_SIZE) or ())
+        except IOError:
+            await ctx.send("Last image isn't valid.")
+            return False
+        if boxes is None:
+            await ctx.send("Couldn't find a transparent box in that image, give its coordinates.")
+            return False
+        if not boxes_fit(boxes, width, height):
+            await ctx.send("Box goes outside of template.")
+            return False
+
+        try:
+            size = await self.save_image(template, template_name)
+            await self.registry.add(template_name, 'template', size, boxes)
+        except IOError:
+            await ctx.send("Couldn't save the image.")
+            return False
+        await ctx.send(f"Added template {template_name} with {describe_boxes(boxes)}.")
+        return True
+
+
+    def sync_aliases(self, added, removed):
+        """Adds and removes the aliases of assets added to and removed from the registry, returns the names skipped"""
+        skipped = []
+        for name in removed:
+            self.bot.remove_command(name)
+        for name in added:
+            if self.bot.get_command(name):
+                skipped.append(name)
+                continue
+            self.add_alias(self.registry.get(name).kind, name)
+        return skipped
+
 
-        advanced_filter_command = None
-        for command_name in command_list:
-            if advanced_filter_command:
-                if advanced_filter_command == 'symm':
-                    side = command_name.lower()
-                    image = advanced_filters['symm'](image, side)
-                elif advanced_filter_command == 'shrink':
-                    per = int(command_name)
-                    image = advanced_filters['shrink'](image, per)
-                elif advanced_filter_command == 'rotate':
-                    rotation = command_name .lower()
-                    image = advanced_filters['rotate'](image, rotation)
-                advanced_filter_command = None
-            elif command_name in Frames.frames:
-                frame = get_frame(command_name)
-                if not frame:
-                    return await ctx.send(f"Couldn't open frame '{frame_name}'.")
-                image = apply_frame(image, frame)
-            elif command_name in Frames.templates:
-                template = get_template(command_name)
-                if not template:
-                    return await ctx.send(f"Couldn't open template '{template_name}'.")
-                image = apply_template(image, template, Frames.templates[command_name])
-            elif command_name in filters:
-                image = filters[command_name](image)
-            elif command_name in advanced_filters:
-                advanced_filter_command = command_name
-        if advanced_filter_command:
-            image = advanced_filters[command_name](image)
-        await send_image(ctx, image, image_message)
+    def add_alias(self, command_name, alias):
+        command = self.bot.get_command(command_name)
+        command.aliases.append(alias)
+        self.bot.all_commands[alias] = command
 
 
+    async def save_image(self, image, name):
+        """Saves 'image' as the next version of the asset 'name', returning its size. It's added to the registry apart."""
+        path = self.registry.upload_path(name)
+        return await self.bot.render_engine.render_to_file(image, [('convert', 'RGBA')], path, ASSET_MAX_SIZE)
 
 
 def setup(client):
@@ -1,9 +1,39 @@
+import collections
+import contextlib
 import discord
 import io
+import os
 from PIL import Image
+from .download import DownloadError, ImageGone, IMAGE_MAX_PIXELS
+from .scheduler import Rejected, Superseded
+from .upload_index import content_hash
 
 
-def get_message_attachment(message, allowed_extensions=('.jpg', '.jpeg', '.png')):
+# uploaded images are shrunk to fit in a MAX_SIZE x MAX_SIZE square before being processed
+MAX_SIZE = int(os.environ.get('IMAGE_MAX_SIZE', 800))
+# modes Image.reduce can average pixels of, palette indices can't be averaged
+REDUCIBLE_MODES = ('L', 'LA', 'RGB', 'RGBA')
+# modes whose pixels are palette indices, most filters can't work on them so they're converted when opened
+PALETTE_MODES = ('P', 'PA')
+# every frame of an animation is processed, so they're shrunk further and their length is capped
+ANIMATION_MAX_SIZE = int(os.environ.get('ANIMATION_MAX_SIZE', 400))
+ANIMATION_MAX_FRAMES = int(os.environ.get('ANIMATION_MAX_FRAMES', 200))
+# in milliseconds
+ANIMATION_MAX_DURATION = int(os.environ.get('ANIMATION_MAX_DURATION', 20 * 1000))
+
+
+# the downloaded bytes of an image, with the id of the attachment they came from
+SourceImage = collections.namedtuple('SourceImage', 'data attachment_id')
+# a rendered image ready to be uploaded, 'format' is the Pillow format name
+Encoded = collections.namedtuple('Encoded', 'data format')
+EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpg', 'WEBP': 'webp', 'GIF': 'gif'}
+
+
+class RenderError(Exception):
+    """Raised while rendering with a message that can be shown to the user"""
+
+
+def get_message_attachment(message, allowed_extensions=('.jpg', '.jpeg', '.png', '.gif', '.webp')):
     """Returns the first attachment from 'message' if it exists and it's a recognized image, otherwise returns None"""
     if message.attachments:
         attachment = message.attachments[0]
@@ -12,8 +42,88 @@ def get_message_attachment(message, allowed_extensions=('.jpg', '.jpeg', '.png')
     return None
 
 
-def open_image(file):
+def get_message_attachments(message, allowed_extensions=('.jpg', '.jpeg', '.png', '.gif', '.webp')):
+    """Returns every attachment from 'message' that's a recognized image"""
+    return [attachment for attachment in message.attachments
+            if attachment.filename.lower().endswith(allowed_extensions)]
+
+
+def fit_size(size, max_size):
+    """Returns the size 'size' shrinks to so it fits in 'max_size', or None if it already fits"""
+    width, height = size
+    if not max_size or (width <= max_size and height <= max_size):
+        return None
+    if width > height:
+        return max_size, height * max_size // width
+    return width * max_size // height, max_size
+
+
+def is_animated(data):
+    """Whether the uploaded bytes 'data' may be an animation, only looking at the header"""
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return True
+    # animated WebPs are extended (VP8X) files with the animation flag set
+    return data[:4] == b'RIFF' and data[8:16] == b'WEBPVP8X' and len(data) > 20 and bool(data[20] & 0x02)
+
+
+def _skip_gif_blocks(data, position):
+    """Returns where the data sub-blocks starting at 'position' end"""
+    while position < len(data) and data[position]:
+        position += data[position] + 1
+    return position + 1
+
+
+def frame_durations(data):
+    """
+    Yields the duration in milliseconds of every frame of the GIF or WebP 'data', the same ones Pillow reads
+    Only the headers of the frames are read, none of them is decoded
+    """
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        # the global color table follows the screen descriptor
+        position = 13 + (3 << (data[10] & 7) + 1 if len(data) > 10 and data[10] & 0x80 else 0)
+        duration = 0
+        while position < len(data):
+            block = data[position]
+            if block == 0x21 and position + 1 < len(data):
+                # extensions, the graphic control one has the delay of the next frame in hundredths of a second
+                if data[position + 1] == 0xF9 and position + 5 < len(data):
+                    duration = int.from_bytes(data[position + 4:position + 6], 'little') * 10
+                position = _skip_gif_blocks(data, position + 2)
+            elif block == 0x2C and position + 9 < len(data):
+                flags = data[position + 9]
+                position += 10 + (3 << (flags & 7) + 1 if flags & 0x80 else 0)
+                # the LZW code size, then the image data
+                position = _skip_gif_blocks(data, position + 1)
+                yield duration
+                duration = 0
+            else:
+                return
+    elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        position = 12
+        while position + 8 <= len(data):
+            chunk = data[position:position + 4]
+            size = int.from_bytes(data[position + 4:position + 8], 'little')
+            if chunk == b'ANMF' and size >= 16:
+                yield int.from_bytes(data[position + 20:position + 23], 'little')
+            # chunks are padded to an even size
+            position += 8 + size + (size & 1)
+
+
+def check_pixels(image):
+    """Raises RenderError if 'image' has too many pixels to decode, only its header has to be read"""
+    if image.width * image.height > IMAGE_MAX_PIXELS:
+        raise RenderError("That image has too many pixels.")
+
+
+def open_image(file, max_size=MAX_SIZE):
+    """
+    Opens an uploaded image shrunk to fit in 'max_size' and rotated as its EXIF orientation says
+    Big images are decoded at a reduced resolution when the format allows it, so the full size
+    image is never in memory. A 'max_size' of None keeps the original size.
+    Palette images, like every GIF, are converted to RGB, or RGBA if they have transparency.
+    """
     image = Image.open(file)
+    check_pixels(image)
     try:
         exif = image._getexif()
     except AttributeError:
@@ -21,13 +131,20 @@ def open_image(file):
     else:
         orientation = exif and exif.get(274)
 
-    if image.width > 800 or image.height > 800:
-        if image.width > image.height:
-            width = 800
-            height = image.height * 800 // image.width
-        else:
-            height = 800
-            width = image.width * 800 // image.height
+    if image.mode in PALETTE_MODES:
+        # converted before shrinking, so they can be reduced like any other image
+        image = image.convert('RGBA' if image.mode == 'PA' or 'transparency' in image.info else 'RGB')
+
+    size = fit_size(image.size, max_size)
+    if size:
+        width, height = size
+        if image.format == 'JPEG':
+            # lets libjpeg scale by 1/2, 1/4 or 1/8 while decoding, never below the requested size
+            image.draft(image.mode, (width, height))
+        elif image.mode in REDUCIBLE_MODES:
+            factor = min(image.width // width, image.height // height)
+            if factor >= 2:
+                image = image.reduce(factor)
         image = image.resize((width, height), resample=Image.LANCZOS)
 
     if not orientation or orientation == 1:
@@ -51,32 +168,59 @@ def open_image(file):
     return image
 
 
+async def read_attachment(ctx, attachment):
+    """
+    Returns a SourceImage for 'attachment', downloading it only if it isn't cached
+    Raises DownloadError without downloading anything if it's too big to use, or if it can't be downloaded
+    """
+    shrunk_size = attachment.width and attachment.height and fit_size((attachment.width, attachment.height), MAX_SIZE)
+    url = ctx.bot.downloader.plan(attachment, shrunk_size)
+
+    async def download():
+        with ctx.bot.metrics.timer('download'):
+            return await ctx.bot.downloader.fetch(url)
+
+    data = await ctx.bot.source_cache.get(attachment.id, download)
+    return SourceImage(data, attachment.id)
+
+
 async def get_last_image(ctx, limit=100):
     """
-    Returns the last image in the last 'limit' messages in the 'ctx' channel
-    Raises IOError if last image isn't a valid image
+    Returns a SourceImage of the last image in the 'ctx' channel and the message it's in
+    The channel's image index is used when possible, otherwise the last 'limit' messages are scanned
+    The image isn't decoded here, that's left to the render engine
     """
     attachment = get_message_attachment(ctx.message)
     if attachment:
-        f = io.BytesIO()
-        await attachment.save(f)
-        return Image.open(f), ctx.message
-    async for m in ctx.history(before=ctx.message, limit=limit):
-        attachment = get_message_attachment(m)
-        if attachment:
-            f = io.BytesIO()
-            await attachment.save(f)
-            image = open_image(f)
-            return image, m
-    return None, None
+        return await read_attachment(ctx, attachment), ctx.message
+    index = ctx.bot.image_index
+    found, indexed = index.last_image(ctx.channel.id)
+    if found:
+        if not indexed:
+            return None, None
+        try:
+            return await read_attachment(ctx, indexed.attachment), discord.Object(id=indexed.message_id)
+        except ImageGone:
+            # deleted without us noticing, forget it and look at the history instead
+            index.remove(ctx.channel.id, {indexed.message_id})
+    with ctx.bot.metrics.timer('history'):
+        async for m in ctx.history(before=ctx.message, limit=limit):
+            attachment = get_message_attachment(m)
+            if attachment:
+                index.seed(ctx.channel.id, m.id, attachment)
+                break
+        else:
+            index.seed(ctx.channel.id)
+            return None, None
+    return await read_attachment(ctx, attachment), m
 
 
 async def get_image(ctx):
     await ctx.trigger_typing()
     try:
         image, message = await get_last_image(ctx)
-    except IOError:
-        await ctx.send("Last image isn't valid.")
+    except DownloadError as e:
+        await ctx.send(str(e))
         return None, None
     if not image:
         await ctx.send("Couldn't find valid image.")
@@ -84,14 +228,105 @@ async def get_image(ctx):
     return image, message
 
 
-async def send_image(ctx, image, image_message):
-    with io.BytesIO() as f:
-        try:
-            image.save(f, format='png')
-        except IOError:
-            return await ctx.send("Image couldn't be saved.")
-        f.seek(0)
-        await ctx.send(file=discord.File(f, filename=ctx.invoked_with + '.png'))
+async def process_image(ctx, image, image_message, operations):
+    """
+    Renders 'operations' on the SourceImage 'image' in the render engine and sends the result
+    Renders wait for their turn in the scheduler, unless the result is cached or already being rendered
+    """
+    try:
+        if result_key(image, operations) in ctx.bot.result_cache:
+            encoded = await render_cached(ctx, image, operations)
+        else:
+            async with scheduled(ctx):
+                encoded = await render_cached(ctx, image, operations)
+    except Superseded:
+        return
+    except (RenderError, Rejected) as e:
+        return await ctx.send(str(e))
+    except IOError:
+        return await ctx.send("Last image isn't valid.")
+    await send_image(ctx, encoded, image_message)
+
+
+def result_key(image, operations, max_size=MAX_SIZE):
+    return (image.attachment_id, max_size, tuple(operations))
+
+
+async def render_cached(ctx, image, operations):
+    """
+    Renders 'operations' on the SourceImage 'image', or returns the cached result
+    Renders wait for the memory they're estimated to take, and are done smaller when there isn't enough
+    """
+    engine = ctx.bot.render_engine
+    key = result_key(image, operations)
+    # expired results aren't in the cache, and nothing runs between the check and the lookup,
+    # so only a result that's cached or already being rendered skips reserving memory
+    if key in ctx.bot.result_cache:
+        with ctx.bot.metrics.timer('render'):
+            return await ctx.bot.result_cache.get(key, lambda: engine.render(image, operations, MAX_SIZE))
+
+    with ctx.bot.metrics.timer('memory'):
+        reservation = await ctx.bot.memory_budget.admit_render(image.data, operations, ctx.bot.asset_registry.assets,
+                                                               engine.workers)
+    try:
+        max_size = reservation.max_size
+        with ctx.bot.metrics.timer('render'):
+            return await ctx.bot.result_cache.get(
+                result_key(image, operations, max_size), lambda: engine.render(image, operations, max_size))
+    finally:
+        reservation.release()
+
+
+@contextlib.asynccontextmanager
+async def scheduled(ctx):
+    """Waits for the command's turn in the scheduler, telling the user if it has to wait"""
+    ticket = ctx.bot.scheduler.submit(ctx.guild and ctx.guild.id, ctx.author.id, ctx.channel.id)
+    try:
+        if ticket.waiting:
+            await ctx.send("I'm busy, your image will be done when it's its turn.", delete_after=10)
+        with ctx.bot.metrics.timer('schedule'):
+            await ticket.wait()
+        yield
+    finally:
+        ticket.release()
+
+
+async def send_reused(ctx, upload):
+    """
+    Points at the already uploaded result 'upload' instead of uploading it again, returns whether it could
+    Commands after this one use the image it points at, like they'd use an uploaded one
+    """
+    if not await ctx.bot.downloader.exists(upload.attachment.url):
+        # deleted without us being told, or its link expired
+        ctx.bot.upload_index.remove({upload.message_id})
+        ctx.bot.upload_index.counters['gone'] += 1
+        return False
+    try:
+        message = await ctx.send(embed=discord.Embed().set_image(url=upload.attachment.url))
+    except discord.HTTPException:
+        return False
+    ctx.bot.image_index.add(ctx.channel.id, message.id, upload.attachment)
+    return True
+
+
+async def send_image(ctx, encoded, image_message):
+    """Sends the Encoded result, or points at where it was last uploaded in the guild if it's still there"""
+    uploads = ctx.bot.upload_index
+    scope = ctx.guild.id if ctx.guild else ctx.channel.id
+    digest = content_hash(encoded.data)
+    with ctx.bot.metrics.timer('upload'):
+        upload = uploads.get(scope, digest)
+        if upload is not None and await send_reused(ctx, upload):
+            uploads.counters['reused'] += 1
+            uploads.counters['reused_bytes'] += len(encoded.data)
+        else:
+            with io.BytesIO(encoded.data) as f:
+                filename = f'{ctx.invoked_with}.{EXTENSIONS[encoded.format]}'
+                message = await ctx.send(file=discord.File(f, filename=filename))
+            uploads.counters['uploaded'] += 1
+            uploads.counters['uploaded_bytes'] += len(encoded.data)
+            if message.attachments:
+                uploads.add(scope, digest, ctx.channel.id, message.id, message.attachments[0])
     try:
         await ctx.message.delete()
     except discord.Forbidden:
@@ -107,11 +342,3 @@ def get_frame(frame):
     except IOError:
         return None
 
-
-def get_template(template):
-    template_path = "frames/" + template + ".png"
-    try:
-        return Image.open(template_path)
-    except IOError:
-        return None
-
@@ -0,0 +1,112 @@
+import collections
+from discord.ext import commands
+from .image_handling import get_message_attachment
+
+
+IndexedImage = collections.namedtuple('IndexedImage', 'message_id attachment')
+
+
+class ChannelImages:
+    """The most recent images of a channel, newest last"""
+
+    def __init__(self, size):
+        self.images = collections.deque(maxlen=size)
+        # complete means there's no older image than the ones in the ring we could be missing
+        self.complete = False
+
+
+class ImageIndex:
+    """
+    Keeps a small ring of recent image attachments for every channel so the last image
+    can be found without scanning the channel history.
+    At most 'max_channels' channels are tracked, dropping the least recently used ones.
+    """
+
+    def __init__(self, max_channels=1000, images_per_channel=5):
+        self.max_channels = max_channels
+        self.images_per_channel = images_per_channel
+        self.channels = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _channel(self, channel_id):
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = ChannelImages(self.images_per_channel)
+            while len(self.channels) > self.max_channels:
+                self.channels.popitem(last=False)
+        else:
+            self.channels.move_to_end(channel_id)
+        return channel
+
+    def add(self, channel_id, message_id, attachment):
+        self._channel(channel_id).images.append(IndexedImage(message_id, attachment))
+
+    def seed(self, channel_id, message_id=None, attachment=None):
+        """Records the result of a history scan, after which the channel is complete"""
+        channel = self._channel(channel_id)
+        if attachment and not any(i.message_id == message_id for i in channel.images):
+            channel.images.appendleft(IndexedImage(message_id, attachment))
+        channel.complete = True
+
+    def remove(self, channel_id, message_ids):
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            return
+        images = [i for i in channel.images if i.message_id not in message_ids]
+        if len(images) != len(channel.images):
+            channel.images.clear()
+            channel.images.extend(images)
+            # there might be older images we never saw that are now the last one
+            if not images:
+                channel.complete = False
+
+    def last_image(self, channel_id):
+        """
+        Returns (found, image) where 'found' tells whether the index knows the answer
+        and 'image' is the last IndexedImage of the channel or None
+        """
+        channel = self.channels.get(channel_id)
+        if channel is not None and (channel.images or channel.complete):
+            self.hits += 1
+            self.channels.move_to_end(channel_id)
+            return True, channel.images[-1] if channel.images else None
+        self.misses += 1
+        return False, None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'channels': len(self.channels),
+            'images': sum(len(c.images) for c in self.channels.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ImageIndexer(commands.Cog):
+
+    def __init__(self, bot):
+        self.bot = bot
+
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        attachment = get_message_attachment(message)
+        if attachment:
+            self.bot.image_index.add(message.channel.id, message.id, attachment)
+
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        self.bot.image_index.remove(payload.channel_id, {payload.message_id})
+
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload):
+        self.bot.image_index.remove(payload.channel_id, payload.message_ids)
+
+
+def setup(bot):
+    bot.add_cog(ImageIndexer(bot))
@@ -0,0 +1,116 @@
+"""
+Pointwise color filters as lookup tables.
+Each filter is a generator of one 256 entry table per RGB channel, consecutive filters compose into
+a single set of tables, so any number of them is a single Image.point pass with alpha left alone.
+Grayscale mixes the channels so it can't be a table, it splits the filters around it in two passes.
+"""
+import functools
+from PIL import ImageOps
+
+
+def _same(table):
+    return table, table, table
+
+
+def _clamp(value):
+    return max(0, min(255, round(value)))
+
+
+def invert():
+    return _same([255 - v for v in range(256)])
+
+
+def posterize(bits=2):
+    mask = ~(2 ** (8 - bits) - 1) & 0xff
+    return _same([v & mask for v in range(256)])
+
+
+def brightness(percent):
+    return _same([_clamp(v * percent / 100) for v in range(256)])
+
+
+def contrast(percent):
+    return _same([_clamp((v - 128) * percent / 100 + 128) for v in range(256)])
+
+
+def threshold(level):
+    return _same([255 if v >= level else 0 for v in range(256)])
+
+
+def gamma(value):
+    return _same([_clamp(255 * (v / 255) ** (1 / value)) for v in range(256)])
+
+
+lut_generators = {
+    'invert': invert,
+    'posterize': posterize,
+    'brightness': brightness,
+    'contrast': contrast,
+    'threshold': threshold,
+    'gamma': gamma,
+}
+
+# the filters that can be fused with the ones above
+FUSABLE = set(lut_generators) | {'grayscale'}
+
+
+def compose(first, then):
+    """The tables of applying 'first' and then 'then'"""
+    return tuple([after[v] for v in before] for before, after in zip(first, then))
+
+
+@functools.lru_cache(maxsize=256)
+def passes(steps):
+    """
+    Turns the (name, *args) pointwise 'steps' into the passes that apply them:
+    lists of tables for Image.point, every channel's one after the other, and 'grayscale'
+    """
+    result = []
+    tables = None
+    for name, *args in steps:
+        if name == 'grayscale':
+            if tables is not None:
+                result.append(sum(tables, []))
+                tables = None
+            result.append('grayscale')
+        else:
+            generated = lut_generators[name](*args)
+            tables = generated if tables is None else compose(tables, generated)
+    if tables is not None:
+        result.append(sum(tables, []))
+    return tuple(result)
+
+
+def apply_tables(color, steps):
+    """
+    Applies the pointwise 'steps' to the RGB image 'color' in as few passes as they compose to
+    The result is RGB, or L after a grayscale step while the tables keep the channels equal
+    """
+    for table in passes(steps):
+        if table == 'grayscale':
+            color = ImageOps.grayscale(color)
+        elif color.mode == 'L' and table[:256] == table[256:512] == table[512:]:
+            color = color.point(table[:256])
+        else:
+            color = color.convert("RGB").point(table)
+    return color
+
+
+def has_grayscale(steps):
+    return any(name == 'grayscale' for name, *args in steps)
+
+
+def apply_pointwise(image, steps):
+    """
+    Applies the pointwise 'steps' to 'image' with its alpha left alone
+    The result is RGB, or RGBA if 'image' had alpha or there's a grayscale step, like the filters on their own
+    """
+    try:
+        alpha = image.getchannel('A')
+    except ValueError:
+        alpha = None
+    image = apply_tables(image.convert("RGB"), steps)
+    image = image.convert("RGBA" if has_grayscale(steps) else "RGB")
+    if alpha:
+        image.putalpha(alpha)
+    return image
@@ -0,0 +1,184 @@
+import asyncio
+import collections
+import io
+import os
+from PIL import Image
+from .encoder import UPLOAD_LIMIT
+from .image_handling import fit_size, is_animated, MAX_SIZE, ANIMATION_MAX_SIZE, PALETTE_MODES
+from .scheduler import Rejected
+
+
+# bytes the images being rendered may take up in the bot and its render workers together, 0 for no limit
+# cluster.py splits it evenly between its bot processes
+MEMORY_BUDGET = int(os.environ.get('MEMORY_BUDGET', 512 * 2**20))
+# seconds a render may wait for memory before it's dropped
+MEMORY_WAIT = float(os.environ.get('MEMORY_WAIT', 30))
+# the sizes images are shrunk to instead of MAX_SIZE when there isn't enough memory left, largest first
+FALLBACK_SIZES = (MAX_SIZE * 3 // 4, MAX_SIZE // 2, MAX_SIZE // 4)
+
+# operations work on RGBA more often than not
+PIXEL_BYTES = 4
+# how many images the size of its result an operation holds at once besides its input
+OPERATION_COPIES = {
+    'blur': 2,
+    'edges': 3,
+    'glitch': 4,
+    'impact': 2,
+    'symm': 2,
+    'transparent': 3,
+    'frame': 2,
+    'template': 3,
+}
+
+# what the header of an uploaded image says about it
+Header = collections.namedtuple('Header', 'width height bands format animated')
+
+
+def read_header(data):
+    """The Header of the image 'data', only its header is read, or None if it isn't an image"""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # palette images are converted to RGBA as soon as they're decoded
+            bands = 4 if image.mode in PALETTE_MODES else len(image.getbands())
+            return Header(image.width, image.height, bands, image.format, is_animated(data))
+    except (OSError, Image.DecompressionBombError):
+        return None
+
+
+def _operation_pixels(name, args, pixels, assets):
+    """How many pixels the result of the operation (name, *args) on 'pixels' pixels has"""
+    if name == 'template':
+        asset = assets.get(args[0])
+        if asset is not None:
+            return asset.width * asset.height
+    elif name == 'scale':
+        for per in args[0]:
+            pixels = pixels * per * per // 10000
+    elif name == 'shrink':
+        pixels = pixels * args[0] * args[0] // 10000
+    return pixels
+
+
+def estimate_footprint(header, data_size, operations, max_size, assets, workers=1):
+    """
+    Estimates the most bytes rendering 'operations' on an upload of 'data_size' bytes with 'header'
+    shrunk to 'max_size' takes at once: the upload, decoding it, the biggest operation and encoding
+    the result. 'assets' is the asset registry's, for the size of templates. Animations are rendered
+    on every one of the 'workers' at once, a frame at a time each.
+    """
+    if header is None:
+        return data_size
+    if header.animated:
+        max_size = min(max_size, ANIMATION_MAX_SIZE) if max_size else ANIMATION_MAX_SIZE
+    width, height = fit_size((header.width, header.height), max_size) or (header.width, header.height)
+    pixels = width * height
+    if header.format == 'JPEG':
+        # libjpeg decodes at most twice as wide and high as asked for
+        decoding = min(header.width * header.height, pixels * 4) * header.bands
+    else:
+        decoding = header.width * header.height * header.bands
+    peak = decoding + pixels * PIXEL_BYTES
+    for name, *args in operations:
+        result = _operation_pixels(name, args, pixels, assets)
+        peak = max(peak, (pixels + result * OPERATION_COPIES.get(name, 1)) * PIXEL_BYTES)
+        pixels = result
+    # the encoder keeps its best attempt while it tries the next
+    encoded = min(UPLOAD_LIMIT, pixels * PIXEL_BYTES)
+    peak = max(peak, pixels * PIXEL_BYTES + 2 * encoded)
+    if header.animated:
+        # the segments of every worker are joined into a single GIF at the end
+        return data_size + peak * workers + 2 * UPLOAD_LIMIT
+    return data_size + peak + encoded
+
+
+class Reservation:
+    """Memory set aside for a render, returned by MemoryBudget.admit"""
+
+    def __init__(self, budget, max_size, size):
+        self.budget = budget
+        self.max_size = max_size
+        self.size = size
+        self.released = False
+
+    def release(self):
+        """Gives the memory back once the render is done"""
+        if not self.released:
+            self.released = True
+            self.budget._release(self.size)
+
+
+class MemoryBudget:
+    """
+    Memory set aside for the renders in flight, from estimates of what they take at their peak.
+    A render is admitted at the largest of MAX_SIZE and FALLBACK_SIZES whose estimate fits in
+    what's left of 'limit', and waits for others to finish if not even the smallest does.
+    A render is always let in when it would be the only one, so none is too big to ever run.
+    """
+
+    def __init__(self, limit=MEMORY_BUDGET, sizes=(MAX_SIZE, *FALLBACK_SIZES), wait=MEMORY_WAIT):
+        self.limit = limit
+        self.sizes = sizes
+        self.wait = wait
+        self.reserved = 0
+        self.peak = 0
+        self.rendering = 0
+        self._waiters = []
+        self.counters = collections.Counter()
+
+    def _fit(self, estimate):
+        """The largest size the render fits at and its estimate there, or None if it doesn't fit"""
+        for max_size in self.sizes:
+            size = estimate(max_size)
+            if not self.limit or not self.rendering or self.reserved + size <= self.limit:
+                return max_size, size
+        return None
+
+    async def admit(self, estimate):
+        """
+        Waits until the render fits and returns its Reservation, 'estimate(max_size)' being its estimated
+        footprint at a size. Raises Rejected if it didn't fit in 'wait' seconds.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.wait
+        fit = self._fit(estimate)
+        if fit is None:
+            self.counters['waited'] += 1
+        while fit is None:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                self.counters['rejected'] += 1
+                raise Rejected("I'm running out of memory, try again in a bit.")
+            released = loop.create_future()
+            self._waiters.append(released)
+            try:
+                await asyncio.wait_for(released, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if released in self._waiters:
+                    self._waiters.remove(released)
+            fit = self._fit(estimate)
+
+        max_size, size = fit
+        self.counters['admitted'] += 1
+        if max_size != self.sizes[0]:
+            self.counters['downscaled'] += 1
+        self.rendering += 1
+        self.reserved += size
+        self.peak = max(self.peak, self.reserved)
+        return Reservation(self, max_size, size)
+
+    async def admit_render(self, data, operations, assets, workers=1):
+        """admit for rendering 'operations' on the uploaded image 'data', see estimate_footprint"""
+        header = read_header(data)
+        return await self.admit(
+            lambda max_size: estimate_footprint(header, len(data), operations, max_size, assets, workers))
+
+    def _release(self, size):
+        self.rendering -= 1
+        self.reserved -= size
+        # every waiting render looks again, a smaller one may fit where the first in line doesn't
+        waiters, self._waiters = self._waiters, []
+        for released in waiters:
+            if not released.done():
+                released.set_result(None)
@@ -0,0 +1,103 @@
+import bisect
+import contextlib
+import contextvars
+import time
+
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# the command the current task is handling, so stages deep in the call stack are labeled with it
+current_command = contextvars.ContextVar('current_command', default='')
+
+
+class Histogram:
+    """Counts of observations per bucket, cumulative only when exported"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is for values above every bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        """Estimates the 'q' quantile by interpolating inside the bucket it falls in"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics:
+    """
+    Latency histograms of the stages a command goes through, labeled by command and operation.
+    Stages are things like 'history', 'download', 'queue', 'decode', 'process', 'encode' and 'upload'.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}  # (stage, command, operation) -> Histogram
+
+    def observe(self, stage, seconds, operation='', command=None):
+        if command is None:
+            command = current_command.get()
+        key = (stage, command, operation)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage, operation='', command=None):
+        """Observes how long the body of the 'with' takes, even if it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, operation, command)
+
+    def by_stage(self):
+        """One Histogram per stage, adding up every command and operation"""
+        stages = {}
+        for (stage, command, operation), histogram in self.histograms.items():
+            stages.setdefault(stage, Histogram(self.buckets)).merge(histogram)
+        return stages
+
+    def exposition(self, prefix='monarchbot'):
+        """The histograms in the Prometheus text format"""
+        name = f'{prefix}_stage_seconds'
+        lines = [f'# HELP {name} Time spent in each stage of handling a command.',
+                 f'# TYPE {name} histogram']
+        for (stage, command, operation), histogram in sorted(self.histograms.items()):
+            labels = f'stage="{_escape(stage)}",command="{_escape(command)}",operation="{_escape(operation)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
@@ -0,0 +1,294 @@
+import functools
+from PIL import Image
+from .filters import filters, advanced_filters
+from .lut import FUSABLE
+
+
+class PipeError(Exception):
+    """Raised when a pipe string isn't valid, with a message that can be shown to the user"""
+
+
+# filters that work on every pixel on its own, so they don't care where pixels are or how many
+POINTWISE = {'invert', 'posterize', 'grayscale', 'transparent', 'brightness', 'contrast', 'threshold', 'gamma', 'point'}
+# the pointwise filters that are linear, so they give about the same result before or after a resize
+LINEAR = {'invert', 'grayscale', 'brightness', 'contrast'}
+
+# geometric operations as matrices mapping (x, y) to where the pixel ends up, y pointing down
+TRANSPOSES = {
+    Image.FLIP_LEFT_RIGHT: ((-1, 0), (0, 1)),
+    Image.FLIP_TOP_BOTTOM: ((1, 0), (0, -1)),
+    Image.ROTATE_90: ((0, 1), (-1, 0)),
+    Image.ROTATE_180: ((-1, 0), (0, -1)),
+    Image.ROTATE_270: ((0, -1), (1, 0)),
+    Image.TRANSPOSE: ((0, 1), (1, 0)),
+    Image.TRANSVERSE: ((0, -1), (-1, 0)),
+}
+IDENTITY = ((1, 0), (0, 1))
+
+# the operations the pipe already has for some transposes, so plans read like pipes
+TRANSPOSE_OPERATIONS = {
+    Image.FLIP_LEFT_RIGHT: ('fliph',),
+    Image.FLIP_TOP_BOTTOM: ('flipv',),
+    Image.ROTATE_90: ('rotate', 'left'),
+    Image.ROTATE_270: ('rotate', 'right'),
+}
+TRANSPOSE_NAMES = {
+    Image.ROTATE_180: 'rotate 180',
+    Image.TRANSPOSE: 'transpose',
+    Image.TRANSVERSE: 'transverse',
+}
+
+
+def _parse_symm(argument):
+    side = argument.lower()
+    if side not in ('left', 'right', 'top', 'bottom'):
+        raise PipeError("Valid sides are 'left', 'right', 'top', and 'bottom'.")
+    return side
+
+
+def _parse_shrink(argument):
+    try:
+        per = int(argument)
+    except ValueError:
+        raise PipeError("The percentage to shrink must be a number.")
+    if not (1 <= per <= 99):
+        raise PipeError("Percentage must be between 1 and 99.")
+    return per
+
+
+def _parse_rotate(argument):
+    rotation = argument.lower()
+    if rotation not in ('left', 'right'):
+        raise PipeError("Rotation must be 'left' or 'right'.")
+    return rotation
+
+
+def _parse_percent(argument):
+    try:
+        percent = int(argument.rstrip('%'))
+    except ValueError:
+        raise PipeError("The percentage must be a number.")
+    if not (0 <= percent <= 1000):
+        raise PipeError("Percentage must be between 0 and 1000.")
+    return percent
+
+
+def _parse_threshold(argument):
+    try:
+        level = int(argument)
+    except ValueError:
+        raise PipeError("The threshold must be a number.")
+    if not (0 <= level <= 255):
+        raise PipeError("Level must be between 0 and 255.")
+    return level
+
+
+def _parse_gamma(argument):
+    try:
+        value = float(argument)
+    except ValueError:
+        raise PipeError("The gamma must be a number.")
+    if not (0.1 <= value <= 10):
+        raise PipeError("Gamma must be between 0.1 and 10.")
+    return value
+
+
+argument_parsers = {
+    'symm': _parse_symm,
+    'shrink': _parse_shrink,
+    'rotate': _parse_rotate,
+    'brightness': _parse_percent,
+    'contrast': _parse_percent,
+    'threshold': _parse_threshold,
+    'gamma': _parse_gamma,
+}
+
+# what advanced filters use when they're not given an argument, made explicit so plans are comparable
+argument_defaults = {
+    'symm': 'left',
+    'shrink': 5,
+    'rotate': 'right',
+    'brightness': 150,
+    'contrast': 150,
+    'threshold': 128,
+    'gamma': 2.2,
+}
+
+
+def parse_pipe(pipe_string, assets):
+    """
+    Turns 'pipe_string' into a list of (name, *args) operations for the render engine.
+    'assets' maps the names of frames and templates to their registry Asset.
+    Arguments of advanced filters are optional, if the next word isn't one the default is used.
+    Raises PipeError if the pipe isn't valid.
+    """
+    def is_command(word):
+        return word in assets or word in filters or word in advanced_filters
+
+    words = pipe_string.split()
+    operations = []
+    i = 0
+    while i < len(words):
+        command_name = words[i]
+        i += 1
+        asset = assets.get(command_name)
+        if asset is not None and asset.kind == 'frame':
+            operations.append(('frame', command_name, asset.version))
+        elif asset is not None:
+            operations.append(('template', command_name, asset.version, asset.boxes))
+        elif command_name in filters:
+            operations.append((command_name,))
+        elif command_name in advanced_filters:
+            argument = argument_defaults[command_name]
+            if i < len(words):
+                try:
+                    argument = argument_parsers[command_name](words[i])
+                except PipeError:
+                    if not is_command(words[i]):
+                        raise
+                else:
+                    i += 1
+            operations.append((command_name, argument))
+        else:
+            raise PipeError(f"{command_name} is not a frame or a template or a filter.")
+    return operations
+
+
+def _transpose_method(operation):
+    """Returns the Image.transpose method 'operation' is equivalent to, or None"""
+    name, *args = operation
+    if name == 'fliph':
+        return Image.FLIP_LEFT_RIGHT
+    if name == 'flipv':
+        return Image.FLIP_TOP_BOTTOM
+    if name == 'rotate':
+        return Image.ROTATE_90 if args[0] == 'left' else Image.ROTATE_270
+    if name == 'transpose':
+        return args[0]
+    return None
+
+
+def _is_resize(operation):
+    return operation[0] in ('shrink', 'scale')
+
+
+def _percentages(operation):
+    name, argument = operation
+    if name == 'scale':
+        return argument
+    return (argument,)
+
+
+def _multiply(a, b):
+    return tuple(tuple(sum(a[i][k] * b[k][j] for k in range(2)) for j in range(2)) for i in range(2))
+
+
+def hoist_resizes(operations):
+    """
+    Moves shrinks before linear filters and transposes, so those work on fewer pixels
+    Non-linear filters like threshold and posterize give something else on shrunk pixels, so they stay first
+    """
+    result = []
+    for operation in operations:
+        position = len(result)
+        if _is_resize(operation):
+            while position and (result[position - 1][0] in LINEAR
+                                or _transpose_method(result[position - 1]) is not None):
+                position -= 1
+        result.insert(position, operation)
+    return result
+
+
+def collapse_resizes(operations):
+    """Turns consecutive shrinks into a single resize to the final size"""
+    result = []
+    for operation in operations:
+        if _is_resize(operation) and result and _is_resize(result[-1]):
+            result[-1] = ('scale', _percentages(result[-1]) + _percentages(operation))
+        else:
+            result.append(operation)
+    return result
+
+
+def merge_transposes(operations):
+    """
+    Combines flips and rotations into at most one transpose, dropping them if they cancel out.
+    Pointwise filters and resizes don't care about orientation, so transposes move past them.
+    """
+    result = []
+    pending = IDENTITY
+
+    def flush():
+        if pending == IDENTITY:
+            return
+        method = next(m for m, matrix in TRANSPOSES.items() if matrix == pending)
+        result.append(TRANSPOSE_OPERATIONS.get(method, ('transpose', method)))
+
+    for operation in operations:
+        method = _transpose_method(operation)
+        if method is not None:
+            pending = _multiply(TRANSPOSES[method], pending)
+        elif operation[0] in POINTWISE or _is_resize(operation):
+            result.append(operation)
+        else:
+            flush()
+            pending = IDENTITY
+            result.append(operation)
+    flush()
+    return result
+
+
+def fuse_pointwise(operations):
+    """Turns runs of color filters into a single 'point' operation, applied as one lookup table, see cogs.lut"""
+    result = []
+    for operation in operations:
+        if operation[0] not in FUSABLE:
+            result.append(operation)
+        elif result and result[-1][0] == 'point':
+            result[-1] = ('point', result[-1][1] + (operation,))
+        elif result and result[-1][0] in FUSABLE:
+            result[-1] = ('point', (result[-1], operation))
+        else:
+            result.append(operation)
+    return result
+
+
+optimization_passes = [
+    hoist_resizes,
+    collapse_resizes,
+    merge_transposes,
+    fuse_pointwise,
+]
+
+
+@functools.lru_cache(maxsize=1024)
+def optimize(operations):
+    """
+    Returns the plan for the 'operations' tuple after every optimization pass.
+    Shrinks are only moved past operations that give the same result either way, up to rounding
+    and the clipping of brightness and contrast at the ends of the range.
+    """
+    operations = list(operations)
+    for optimization_pass in optimization_passes:
+        operations = optimization_pass(operations)
+    return tuple(operations)
+
+
+def describe(operation):
+    name, *args = operation
+    if name in ('frame', 'template'):
+        return args[0]
+    if name == 'transpose':
+        return TRANSPOSE_NAMES[args[0]]
+    if name == 'scale':
+        return 'shrink ' + ' then '.join(f'{per}%' for per in args[0])
+    if name == 'point':
+        return '(' + ' + '.join(describe(step) for step in args[0]) + ')'
+    return ' '.join([name] + [str(arg) for arg in args])
+
+
+def explain(operations, plan):
+    """Shows how the pipe was understood and what will actually be run"""
+    parsed = ' → '.join(describe(operation) for operation in operations) or 'nothing'
+    planned = ' → '.join(describe(operation) for operation in plan) or 'nothing'
+    return f"```\nParsed: {parsed}\nPlan:   {planned}\n```"
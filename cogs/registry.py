@@ -0,0 +1,240 @@
+import asyncio
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+
+# 'boxes' is a tuple of (x1, y1, x2, y2) boxes for templates and None for frames
+# 'version' changes whenever the asset does and is never reused
+Asset = collections.namedtuple('Asset', 'name kind width height boxes checksum version')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS assets (
+    name TEXT PRIMARY KEY,
+    kind TEXT NOT NULL CHECK (kind IN ('frame', 'template')),
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    boxes TEXT,
+    checksum TEXT NOT NULL,
+    version INTEGER NOT NULL
+)
+"""
+
+
+def checksum(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _asset(row):
+    name, kind, width, height, boxes, digest, version = row
+    boxes = boxes and tuple(tuple(box) for box in json.loads(boxes))
+    return Asset(name, kind, width, height, boxes, digest, version)
+
+
+class AssetRegistry:
+    """
+    The frames and templates, with their size, boxes and checksum, stored in SQLite.
+    Lookups are served from memory. Changes are committed in a single transaction each on an I/O
+    thread, so the event loop never waits on the disk, and memory is only updated once they're committed.
+    Versions come from a counter kept in the database, so caches keyed by (name, version) never
+    mix up an asset with one that had the same name before.
+    """
+
+    def __init__(self, directory='frames', database='assets.db'):
+        self.directory = directory
+        self.assets = {}
+        self._io = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(directory, exist_ok=True)
+        # only ever used from the I/O thread after this
+        self._db = sqlite3.connect(os.path.join(directory, database), check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(SCHEMA)
+        self._import_lists()
+        self.assets = self._read()
+        self._data_version = self._db.execute('PRAGMA data_version').fetchone()[0]
+
+    def __contains__(self, name):
+        return name in self.assets
+
+    def get(self, name, kind=None):
+        """The Asset called 'name', or None if there isn't one or it's not of 'kind'"""
+        asset = self.assets.get(name)
+        if asset is None or (kind is not None and asset.kind != kind):
+            return None
+        return asset
+
+    def names(self, kind):
+        return [name for name, asset in self.assets.items() if asset.kind == kind]
+
+    def image_path(self, name):
+        return os.path.join(self.directory, f'{name}.png')
+
+    def upload_path(self, name):
+        """Where to write a new image for 'name' before it's added, so the current one stays valid until then"""
+        return os.path.join(self.directory, f'.new-{name}.png')
+
+    async def _run(self, function, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._io, function, *args)
+
+    async def add(self, name, kind, size, boxes=None):
+        """
+        Adds or replaces 'name' with the image written to upload_path(name), of 'size'.
+        Returns the new Asset.
+        """
+        asset = await self._run(self._add, name, kind, size, boxes)
+        self.assets[name] = asset
+        return asset
+
+    async def move(self, name, boxes):
+        """Changes the boxes of the template 'name'"""
+        asset = await self._run(self._move, name, boxes)
+        self.assets[name] = asset
+        return asset
+
+    async def remove(self, name):
+        """Removes 'name' from the registry, its image is left where it is"""
+        await self._run(self._remove, name)
+        del self.assets[name]
+
+    async def reload(self):
+        """Reads the registry again, returning the names that were added and removed"""
+        assets = await self._run(self._read)
+        added = assets.keys() - self.assets.keys()
+        removed = self.assets.keys() - assets.keys()
+        self.assets = assets
+        return added, removed
+
+    async def reload_if_changed(self):
+        """
+        Reloads the registry if another process changed it since it was last read, see reload.
+        Returns None if it didn't change.
+        """
+        assets = await self._run(self._read_if_changed)
+        if assets is None:
+            return None
+        added = assets.keys() - self.assets.keys()
+        removed = self.assets.keys() - assets.keys()
+        self.assets = assets
+        return added, removed
+
+    def _read_if_changed(self):
+        # data_version only changes when another connection commits
+        data_version = self._db.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return None
+        self._data_version = data_version
+        return self._read()
+
+    def _read(self):
+        rows = self._db.execute('SELECT name, kind, width, height, boxes, checksum, version FROM assets')
+        return {row[0]: _asset(row) for row in rows}
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def _next_version(self):
+        version = self._db.execute('PRAGMA user_version').fetchone()[0] + 1
+        self._db.execute(f'PRAGMA user_version = {version}')
+        return version
+
+    def _write(self, name, kind, size, boxes, digest):
+        boxes = boxes and tuple(tuple(box) for box in boxes)
+        version = self._next_version()
+        self._db.execute('INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (name, kind, size[0], size[1], boxes and json.dumps(boxes), digest, version))
+        return Asset(name, kind, size[0], size[1], boxes, digest, version)
+
+    def _add(self, name, kind, size, boxes):
+        upload = self.upload_path(name)
+        # the image is swapped in last, so the row is rolled back if that fails,
+        # they only disagree if the commit fails after the swap
+        try:
+            with self._transaction():
+                asset = self._write(name, kind, size, boxes, checksum(upload))
+                os.replace(upload, self.image_path(name))
+        except BaseException:
+            # an image that couldn't be added isn't left behind
+            with contextlib.suppress(OSError):
+                os.remove(upload)
+            raise
+        return asset
+
+    def _move(self, name, boxes):
+        asset = self.assets[name]
+        with self._transaction():
+            return self._write(name, asset.kind, (asset.width, asset.height), boxes, asset.checksum)
+
+    def _remove(self, name):
+        with self._transaction():
+            self._db.execute('DELETE FROM assets WHERE name = ?', (name,))
+            self._next_version()
+
+    def _import_lists(self):
+        """
+        Moves frames.txt and templates.txt into the registry, the lists are left as they were
+        It's only done once, while the version counter hasn't started, even if there was nothing to import
+        """
+        with self._transaction():
+            # checked in the transaction, so processes starting together don't both import
+            if self._db.execute('PRAGMA user_version').fetchone()[0]:
+                return
+            imported = self._import_entries(self._read_lists())
+            self._next_version()
+        if imported:
+            logging.info(f"Imported {imported} frames and templates into the asset registry.")
+
+    def _read_lists(self):
+        entries = []
+        try:
+            with open(os.path.join(self.directory, 'frames.txt')) as f:
+                entries += [(name, None) for name in f.read().split()]
+        except FileNotFoundError:
+            pass
+        try:
+            with open(os.path.join(self.directory, 'templates.txt')) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    name, *coords = line.split()
+                    try:
+                        x1, y1, x2, y2 = [int(x) for x in coords]
+                    except ValueError as e:
+                        logging.warning(e)
+                    else:
+                        entries.append((name, ((x1, y1, x2, y2),)))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _import_entries(self, entries):
+        imported = 0
+        for name, boxes in entries:
+            path = self.image_path(name)
+            try:
+                with Image.open(path) as image:
+                    size = image.size
+            except IOError:
+                logging.warning(f"Couldn't import {name}, {path} isn't a valid image.")
+                continue
+            self._write(name, 'frame' if boxes is None else 'template', size, boxes, checksum(path))
+            imported += 1
+        return imported
+
+    def close(self):
+        self._io.shutdown()
+        self._db.close()
@@ -0,0 +1,382 @@
+import asyncio
+import collections
+import contextlib
+import io
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from PIL import ImageDraw, Image
+from .assets import AssetStore
+from .cache import LRUCache, image_size
+from .encoder import encode, gif_frame, gif_header, GIF_TRAILER, UPLOAD_LIMIT
+from .metrics import Metrics
+from .image_handling import (open_image, check_pixels, fit_size, is_animated, frame_durations, RenderError, Encoded,
+                             MAX_SIZE, ANIMATION_MAX_SIZE, ANIMATION_MAX_FRAMES, ANIMATION_MAX_DURATION)
+from .filters import filters, advanced_filters, impact
+from .frames import apply_frame, apply_template, detect_template
+from .lut import apply_pointwise, FUSABLE
+from .canvas import Canvas
+
+
+# decoded images of the worker process, keyed by (attachment id, max size)
+decoded_images = LRUCache(max_bytes=64 * 2**20, ttl=10 * 60, sizeof=image_size)
+# frames and templates of the worker process
+assets = AssetStore()
+# counters jobs add to while they run, reported back with their result
+job_counters = collections.Counter()
+# (stage, operation, seconds) of what jobs spent their time on, reported back with their result
+job_timings = []
+# animations are split in segments of at least this many frames, each rendered by a different worker
+MIN_SEGMENT_FRAMES = 8
+
+# tiles of contact sheets are squares this many pixels wide
+SHEET_TILE = int(os.environ.get('SHEET_TILE', 256))
+
+# 'duration' is in milliseconds, 'loop' is None when the animation plays once
+Animation = collections.namedtuple('Animation', 'frames duration loop')
+
+
+@contextlib.contextmanager
+def timed(stage, operation=''):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        job_timings.append((stage, operation, time.perf_counter() - start))
+
+
+def decode(source, max_size=MAX_SIZE):
+    """
+    Opens 'source', which is either a SourceImage of an uploaded image or the path of a stored one
+    Decoded uploads are cached, so a copy is returned that can be modified freely
+    """
+    if isinstance(source, str):
+        return Image.open(source)
+    key = (source.attachment_id, max_size)
+    image = decoded_images.get(key)
+    if image is None:
+        f = io.BytesIO(source.data)
+        image = open_image(f, max_size)
+        image.load()
+        decoded_images.put(key, image)
+    return image.copy()
+
+
+def decode_frames(source, start, stop, max_size=ANIMATION_MAX_SIZE):
+    """
+    Yields the frames from 'start' to 'stop' of the animated SourceImage 'source' with their duration
+    Frames are decoded one at a time as they're asked for, so only one of them is in memory.
+    GIF and WebP frames are drawn over the ones before them, so seeking to 'start' decodes every
+    earlier frame too: the decoding of later segments takes longer, only what comes after is split.
+    """
+    with Image.open(io.BytesIO(source.data)) as animation:
+        for index in range(start, stop):
+            with timed('decode'):
+                animation.seek(index)
+                frame = animation.convert('RGBA')
+                size = fit_size(frame.size, max_size)
+                if size:
+                    frame = frame.resize(size, resample=Image.LANCZOS)
+            # read after converting, some formats only know the duration once the frame is loaded
+            yield frame, animation.info.get('duration', 0)
+
+
+def _frame(image, frame_name, version):
+    frame = assets.frame(frame_name, version, image.size)
+    if not frame:
+        raise RenderError(f"Couldn't open frame '{frame_name}'.")
+    return apply_frame(image, frame)
+
+
+def _template(image, template_name, version, boxes):
+    layers = assets.template_layers(template_name, version, boxes)
+    if not layers:
+        raise RenderError(f"Couldn't open template '{template_name}'.")
+    return apply_template(image, layers)
+
+
+def _impact(image, top, bottom=''):
+    try:
+        return impact(image, top, bottom)
+    except IOError:
+        raise RenderError("Couldn't open the font.")
+
+
+def _outline(image, box):
+    draw = ImageDraw.Draw(image)
+    draw.rectangle(box, outline=(255, 0, 0, 255), width=2)
+    return image
+
+
+def _convert(image, mode):
+    return image.convert(mode)
+
+
+def _transpose(image, method):
+    return image.transpose(method)
+
+
+def _scale(image, percentages):
+    """Like consecutive shrinks, but with a single resize to the size they would end at"""
+    image = image.convert("RGBA")
+    w, h = image.size
+    for per in percentages:
+        w = w * per // 100
+        h = h * per // 100
+    return image.resize((w, h), resample=Image.LANCZOS)
+
+
+operations = {
+    **filters,
+    **advanced_filters,
+    'impact': _impact,
+    'frame': _frame,
+    'template': _template,
+    'outline': _outline,
+    'convert': _convert,
+    'transpose': _transpose,
+    'scale': _scale,
+    'point': apply_pointwise,
+}
+
+
+# what each operation works on, the rest need the whole image:
+# 'color' ones are cogs.lut steps that leave alpha alone, 'bands' ones do the same to every band on its own
+operation_modes = {
+    **{name: 'color' for name in FUSABLE},
+    'point': 'color',
+    'fliph': 'bands',
+    'flipv': 'bands',
+    'rotate': 'bands',
+    'transpose': 'bands',
+}
+
+
+def apply_operations(image, operation_list):
+    """
+    Applies every (name, *args) operation of 'operation_list' to image in order
+    The image goes through a Canvas, so it's only converted when an operation needs it to be
+    """
+    canvas = Canvas(image)
+    # the canvas lets go of the image once it's been converted, so should we
+    del image
+    for name, *args in operation_list:
+        with timed('process', name):
+            mode = operation_modes.get(name)
+            if mode == 'color':
+                canvas.point(args[0] if name == 'point' else ((name, *args),))
+            elif mode == 'bands':
+                canvas.each_band(operations[name], *args)
+            else:
+                canvas.apply(operations[name], *args)
+    return canvas.image()
+
+
+def render(source, operation_list, max_size=MAX_SIZE):
+    """Worker job: decodes 'source', applies 'operation_list' and returns the Encoded result"""
+    with timed('decode'):
+        image = decode(source, max_size)
+    image = apply_operations(image, operation_list)
+    with timed('encode'):
+        return encode(image, job_counters)
+
+
+def probe_animation(source):
+    """
+    Worker job: returns the Animation the SourceImage 'source' is, or None if it's a still image
+    Raises RenderError as soon as it's known to be longer than what's allowed
+    Frames are counted from their headers, none of them is decoded
+    """
+    with Image.open(io.BytesIO(source.data)) as image:
+        check_pixels(image)
+        if not getattr(image, 'is_animated', False):
+            return None
+        loop = image.info.get('loop')
+    frames = duration = 0
+    for frame_duration in frame_durations(source.data):
+        frames += 1
+        duration += frame_duration
+        if frames > ANIMATION_MAX_FRAMES:
+            raise RenderError(f"Animations can't have more than {ANIMATION_MAX_FRAMES} frames.")
+        if duration > ANIMATION_MAX_DURATION:
+            raise RenderError(f"Animations can't be longer than {ANIMATION_MAX_DURATION / 1000:g} seconds.")
+    if not frames:
+        # headers we can't read, it's rendered like a still image
+        return None
+    return Animation(frames, duration, loop)
+
+
+def render_frames(source, operation_list, start, stop, max_size=ANIMATION_MAX_SIZE):
+    """
+    Worker job: applies 'operation_list' to the frames from 'start' to 'stop' of the animated 'source'
+    Returns the size of the frames and their GIF encoded data, ready to go between a header and a trailer
+    """
+    size = None
+    data = []
+    for frame, duration in decode_frames(source, start, stop, max_size):
+        frame = apply_operations(frame, operation_list)
+        size = frame.size
+        with timed('encode'):
+            data.append(gif_frame(frame, duration, job_counters))
+    return size, b''.join(data)
+
+
+def contact_sheet(results, tile=SHEET_TILE):
+    """Worker job: tiles the Encoded 'results' in a grid, in order, and returns it Encoded. Animations show their first frame."""
+    columns = math.ceil(math.sqrt(len(results)))
+    rows = math.ceil(len(results) / columns)
+    sheet = Image.new('RGBA', (columns * tile, rows * tile))
+    for index, result in enumerate(results):
+        with timed('decode'), Image.open(io.BytesIO(result.data)) as image:
+            image = image.convert('RGBA')
+            image.thumbnail((tile, tile), Image.LANCZOS)
+        row, column = divmod(index, columns)
+        sheet.paste(image, (column * tile + (tile - image.width) // 2, row * tile + (tile - image.height) // 2))
+    with timed('encode'):
+        return encode(sheet, job_counters)
+
+
+def render_to_file(source, operation_list, path, max_size=MAX_SIZE):
+    """Worker job: like render, but saves the result to 'path' and returns its size"""
+    image = apply_operations(decode(source, max_size), operation_list)
+    image.save(path)
+    return image.size
+
+
+def measure(source, max_size=MAX_SIZE):
+    """Worker job: returns the size 'source' has once decoded"""
+    return decode(source, max_size).size
+
+
+def render_detection(source, max_size=MAX_SIZE):
+    """Worker job: returns the detected template box of 'source' and the image with the box drawn"""
+    image = decode(source, max_size)
+    box = detect_template(image)
+    if box is None:
+        return None, None
+    with timed('encode'):
+        return box, encode(_outline(image, box), job_counters)
+
+
+def detect_box(source, max_size=MAX_SIZE):
+    """Worker job: returns the detected template box of 'source'"""
+    return detect_template(decode(source, max_size))
+
+
+# the caches of the worker process, by the prefix of the counters they report
+worker_caches = {
+    'decoded': decoded_images,
+    'asset': assets.decoded,
+    'resized_frame': assets.resized,
+    'template_layers': assets.layers,
+}
+
+
+def run_job(job, *args):
+    """
+    Runs 'job(*args)' and returns its result with its counters, how the worker's caches changed
+    and the timings of its stages
+    """
+    job_counters.clear()
+    job_timings.clear()
+    before = {prefix: cache.counters.copy() for prefix, cache in worker_caches.items()}
+    result = job(*args)
+    counters = dict(job_counters)
+    for prefix, cache in worker_caches.items():
+        for name, count in (cache.counters - before[prefix]).items():
+            counters[f'{prefix}_{name}'] = count
+    return result, counters, list(job_timings)
+
+
+class RenderEngine:
+    """
+    A bounded process pool for image jobs.
+    At most 'max_pending' jobs are submitted at once, the rest wait on the event loop
+    """
+
+    def __init__(self, workers=None, max_pending=None, metrics=None):
+        self.workers = workers or int(os.environ.get('RENDER_WORKERS', 0)) or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 2
+        self.pending = 0
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._executor = None
+        # counters reported by the workers, like their decoded image cache hits
+        self.counters = collections.Counter()
+        # how long jobs waited for a slot and what the workers spent their time on
+        self.metrics = metrics or Metrics()
+
+    @property
+    def queued(self):
+        """How many jobs are waiting for a slot"""
+        return max(0, self.pending - self.max_pending)
+
+    @property
+    def executor(self):
+        # created lazily so the workers fork after every cog has been loaded
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def run(self, job, *args):
+        """Runs 'job(*args)' in a worker process and returns its result"""
+        self.pending += 1
+        try:
+            with self.metrics.timer('queue'):
+                await self._slots.acquire()
+            try:
+                result, counters, timings = await self._execute(job, *args)
+            finally:
+                self._slots.release()
+        finally:
+            self.pending -= 1
+        self.counters.update(counters)
+        for stage, operation, seconds in timings:
+            self.metrics.observe(stage, seconds, operation)
+        return result
+
+    async def _execute(self, job, *args):
+        """Returns what run_job returns for 'job(*args)'"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, run_job, job, *args)
+
+    async def render(self, source, operation_list, max_size=MAX_SIZE):
+        if not isinstance(source, str) and is_animated(source.data):
+            animation = await self.run(probe_animation, source)
+            if animation:
+                max_size = min(max_size, ANIMATION_MAX_SIZE) if max_size else ANIMATION_MAX_SIZE
+                return await self.render_animation(source, operation_list, animation, max_size)
+        return await self.run(render, source, operation_list, max_size)
+
+    async def render_animation(self, source, operation_list, animation, max_size=ANIMATION_MAX_SIZE):
+        """Renders 'animation' in segments spread over the workers and joins them into an Encoded GIF"""
+        step = max(MIN_SEGMENT_FRAMES, -(-animation.frames // self.workers))
+        segments = await asyncio.gather(*(
+            self.run(render_frames, source, operation_list, start, min(start + step, animation.frames), max_size)
+            for start in range(0, animation.frames, step)))
+        size = segments[0][0]
+        data = b''.join([gif_header(size, animation.loop), *(frames for _, frames in segments), GIF_TRAILER])
+        self.counters['animation_frames'] += animation.frames
+        if len(data) > UPLOAD_LIMIT:
+            raise RenderError("The result is too big to upload.")
+        return Encoded(data, 'GIF')
+
+    async def contact_sheet(self, results):
+        return await self.run(contact_sheet, results)
+
+    async def render_to_file(self, source, operation_list, path, max_size=MAX_SIZE):
+        return await self.run(render_to_file, source, operation_list, path, max_size)
+
+    async def measure(self, source, max_size=MAX_SIZE):
+        return await self.run(measure, source, max_size)
+
+    async def detect(self, source, max_size=MAX_SIZE):
+        return await self.run(render_detection, source, max_size)
+
+    async def detect_box(self, source, max_size=MAX_SIZE):
+        return await self.run(detect_box, source, max_size)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -0,0 +1,153 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import pickle
+import signal
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from .image_handling import RenderError
+from .render import RenderEngine, run_job
+
+
+# messages are pickles prefixed by their length, the socket is only reachable by this user
+HEADER = struct.Struct('!I')
+
+
+async def read_message(reader):
+    size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return pickle.loads(await reader.readexactly(size))
+
+
+def write_message(writer, message):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    writer.write(HEADER.pack(len(data)) + data)
+
+
+async def serve(path, workers):
+    """
+    Runs a render worker pool shared by every bot process connecting to the unix socket at 'path'
+    Requests are (id, job, args) and get (id, ok, run_job's result or the exception) back, in any order
+    """
+    # spawned rather than forked, so workers don't hold on to the connections open when they start
+    # and clients notice when the server goes away
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    loop = asyncio.get_event_loop()
+
+    async def respond(writer, request_id, job, args):
+        try:
+            response = (request_id, True, await loop.run_in_executor(pool, run_job, job, *args))
+        except Exception as e:
+            response = (request_id, False, e)
+        if writer.is_closing():
+            return
+        try:
+            write_message(writer, response)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            write_message(writer, (request_id, False, RenderError(f"Couldn't send the result back: {e}")))
+
+    async def handle(reader, writer):
+        tasks = set()
+        try:
+            while True:
+                request = await read_message(reader)
+                task = loop.create_task(respond(writer, *request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            # jobs already running in the pool finish anyway, there's just nobody to tell
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    if os.path.exists(path):
+        os.remove(path)
+    server = await asyncio.start_unix_server(handle, path)
+    os.chmod(path, 0o600)
+    logging.info(f"Render server with {workers} workers listening on {path}.")
+    serving = loop.create_task(server.serve_forever())
+    loop.add_signal_handler(signal.SIGTERM, serving.cancel)
+    try:
+        await serving
+    except asyncio.CancelledError:
+        pass
+    finally:
+        server.close()
+        pool.shutdown()
+        logging.info("Render server stopped.")
+
+
+def run_server(path, workers):
+    asyncio.run(serve(path, workers))
+
+
+class RemoteRenderEngine(RenderEngine):
+    """
+    A RenderEngine whose jobs run in the render server at 'path' instead of its own pool
+    'workers' is the size of the server's pool, used to split animations
+    """
+
+    def __init__(self, path, workers, max_pending=None, metrics=None):
+        super().__init__(workers, max_pending, metrics)
+        self.path = path
+        self._writer = None
+        self._reading = None
+        self._connecting = asyncio.Lock()
+        self._responses = {}
+        self._ids = itertools.count()
+
+    async def _connection(self):
+        """The connection to the server, connecting again if it was lost"""
+        async with self._connecting:
+            if self._writer is None or self._writer.is_closing():
+                try:
+                    reader, self._writer = await asyncio.open_unix_connection(self.path)
+                except OSError as e:
+                    logging.warning(f"Couldn't connect to the render server at {self.path}: {e}")
+                    raise RenderError("The renderer isn't available right now, try again later.")
+                self._reading = asyncio.ensure_future(self._read_responses(reader, self._writer))
+        return self._writer
+
+    async def _read_responses(self, reader, writer):
+        try:
+            while True:
+                request_id, ok, payload = await read_message(reader)
+                future = self._responses.pop(request_id, None)
+                if future is None or future.done():
+                    continue
+                if ok:
+                    future.set_result(payload)
+                else:
+                    future.set_exception(payload)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logging.warning(f"Lost the connection to the render server: {e!r}")
+        finally:
+            writer.close()
+            responses, self._responses = self._responses, {}
+            for future in responses.values():
+                if not future.done():
+                    future.set_exception(RenderError("The renderer restarted, try again."))
+
+    async def _execute(self, job, *args):
+        writer = await self._connection()
+        request_id = next(self._ids)
+        future = self._responses[request_id] = asyncio.get_event_loop().create_future()
+        try:
+            write_message(writer, (request_id, job, args))
+            await writer.drain()
+            return await future
+        except ConnectionError:
+            writer.close()
+            raise RenderError("The renderer restarted, try again.")
+        finally:
+            self._responses.pop(request_id, None)
+
+    def shutdown(self):
+        if self._reading is not None:
+            self._reading.cancel()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
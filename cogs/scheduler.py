@@ -0,0 +1,176 @@
+import asyncio
+import collections
+import os
+
+
+# how many jobs run at once, by default one per render worker
+JOB_CONCURRENCY = int(os.environ.get('JOB_CONCURRENCY', 0))
+# seconds a job may wait in line before it's dropped
+JOB_DEADLINE = float(os.environ.get('JOB_DEADLINE', 30))
+# jobs waiting in line, in total and by user
+JOB_QUEUE_LIMIT = int(os.environ.get('JOB_QUEUE_LIMIT', 100))
+JOB_USER_LIMIT = int(os.environ.get('JOB_USER_LIMIT', 3))
+# guilds that get more than one job per turn, as 'guild_id:weight,guild_id:weight'
+JOB_WEIGHTS = os.environ.get('JOB_WEIGHTS', '')
+
+
+class Rejected(Exception):
+    """The job was turned down or dropped from the line, with a message for the user"""
+
+
+class Superseded(Exception):
+    """The job was replaced by a newer one of the same user in the same channel before it started"""
+
+
+def parse_weights(weights):
+    """Reads JOB_WEIGHTS into {guild_id: weight}"""
+    parsed = {}
+    for entry in weights.split(','):
+        if entry.strip():
+            guild_id, weight = entry.split(':')
+            parsed[int(guild_id)] = int(weight)
+    return parsed
+
+
+class Ticket:
+    """A job's place in line, returned by Scheduler.submit"""
+
+    def __init__(self, scheduler, guild_id, user_id, channel_id):
+        self.scheduler = scheduler
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.turn = asyncio.get_event_loop().create_future()
+        self.expiry = None
+
+    @property
+    def waiting(self):
+        return not self.turn.done()
+
+    async def wait(self):
+        """Waits for the job's turn, raises Rejected if it took too long and Superseded if it was replaced"""
+        await self.turn
+
+    def release(self):
+        """Frees the job's slot once it's done, or its place in line if it never got its turn"""
+        if self.turn.done() and not self.turn.cancelled() and self.turn.exception() is None:
+            self.scheduler._release()
+        else:
+            self.scheduler._remove(self)
+
+
+class Scheduler:
+    """
+    Decides which image job runs next so no guild or user can starve the others.
+    Guilds take turns, a guild with a weight of n getting n jobs per turn, and so do the users
+    with jobs waiting in each guild. At most 'concurrency' jobs run at once.
+    Jobs that waited longer than 'deadline' seconds are dropped, and a user's queued job is
+    replaced by the next one they start in the same channel.
+    """
+
+    def __init__(self, concurrency, deadline=JOB_DEADLINE, max_queued=JOB_QUEUE_LIMIT,
+                 max_user_queued=JOB_USER_LIMIT, weights=None):
+        self.concurrency = concurrency
+        self.deadline = deadline
+        self.max_queued = max_queued
+        self.max_user_queued = max_user_queued
+        self.weights = parse_weights(JOB_WEIGHTS) if weights is None else weights
+        self.running = 0
+        self.queued = 0
+        # guild_id -> user_id -> tickets waiting, in the order they take turns
+        self.guilds = collections.OrderedDict()
+        # (user_id, channel_id) -> the ticket waiting there
+        self.latest = {}
+        # jobs the guild first in line got this turn
+        self._served = 0
+        self.counters = collections.Counter()
+
+    def submit(self, guild_id, user_id, channel_id):
+        """Puts a job in line and returns its Ticket, raises Rejected if the line is full"""
+        previous = self.latest.get((user_id, channel_id))
+        if previous is not None and previous.waiting:
+            self._remove(previous)
+            previous.turn.set_exception(Superseded())
+            # nobody may be waiting on it anymore
+            previous.turn.exception()
+            self.counters['superseded'] += 1
+        users = self.guilds.get(guild_id, {})
+        if self.queued >= self.max_queued:
+            self.counters['rejected'] += 1
+            raise Rejected("I'm too busy right now, try again in a bit.")
+        if len(users.get(user_id, ())) >= self.max_user_queued:
+            self.counters['rejected'] += 1
+            raise Rejected("You already have enough images waiting, wait for those first.")
+
+        ticket = Ticket(self, guild_id, user_id, channel_id)
+        self.guilds.setdefault(guild_id, collections.OrderedDict()).setdefault(user_id, collections.deque()).append(ticket)
+        self.latest[(user_id, channel_id)] = ticket
+        self.queued += 1
+        self._dispatch()
+        if ticket.waiting:
+            ticket.expiry = asyncio.get_event_loop().call_later(self.deadline, self._expire, ticket)
+        return ticket
+
+    def _dispatch(self):
+        while self.running < self.concurrency and self.guilds:
+            ticket = self._next()
+            if ticket.turn.done():
+                # its command was cancelled while it waited and it's about to be released
+                continue
+            self.running += 1
+            self.counters['started'] += 1
+            if ticket.expiry is not None:
+                ticket.expiry.cancel()
+            ticket.turn.set_result(None)
+
+    def _next(self):
+        """Takes the ticket whose turn it is out of line"""
+        guild_id, users = next(iter(self.guilds.items()))
+        user_id, tickets = next(iter(users.items()))
+        ticket = tickets.popleft()
+        self._forget(ticket)
+        if tickets:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+        self._served += 1
+        if not users:
+            del self.guilds[guild_id]
+            self._served = 0
+        elif self._served >= self.weights.get(guild_id, 1):
+            self.guilds.move_to_end(guild_id)
+            self._served = 0
+        return ticket
+
+    def _forget(self, ticket):
+        self.queued -= 1
+        if self.latest.get((ticket.user_id, ticket.channel_id)) is ticket:
+            del self.latest[(ticket.user_id, ticket.channel_id)]
+
+    def _remove(self, ticket):
+        """Takes 'ticket' out of line if it's still in it"""
+        users = self.guilds.get(ticket.guild_id)
+        tickets = users and users.get(ticket.user_id)
+        if not tickets or ticket not in tickets:
+            return
+        tickets.remove(ticket)
+        self._forget(ticket)
+        if ticket.expiry is not None:
+            ticket.expiry.cancel()
+        if not tickets:
+            del users[ticket.user_id]
+        if not users:
+            if next(iter(self.guilds)) == ticket.guild_id:
+                self._served = 0
+            del self.guilds[ticket.guild_id]
+
+    def _expire(self, ticket):
+        self._remove(ticket)
+        if ticket.waiting:
+            ticket.turn.set_exception(Rejected("I was too busy to get to that in time, try again."))
+            ticket.turn.exception()
+            self.counters['expired'] += 1
+
+    def _release(self):
+        self.running -= 1
+        self._dispatch()
@@ -0,0 +1,136 @@
+import logging
+import os
+from aiohttp import web
+from discord.ext import commands
+from .metrics import current_command
+
+
+# the metrics endpoint only listens locally by default, a METRICS_PORT of 0 turns it off
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9464))
+# the render engine counters that are cache lookups, by cache
+WORKER_CACHES = ('decoded', 'asset', 'resized_frame', 'template_layers')
+
+
+async def label_command(ctx):
+    current_command.set(ctx.invoked_with)
+
+
+def hit_rate(hits, misses):
+    lookups = hits + misses
+    return hits / lookups if lookups else 0.0
+
+
+def cache_stats(bot):
+    """(name, hits, misses, stats) of every cache the bot and its workers have"""
+    for name in ('source', 'result'):
+        stats = getattr(bot, f'{name}_cache').stats()
+        yield name, stats['hits'], stats['misses'], stats
+    stats = bot.image_index.stats()
+    yield 'image_index', stats['hits'], stats['misses'], stats
+    stats = bot.upload_index.stats()
+    yield 'upload_index', stats['hits'], stats['misses'], stats
+    counters = bot.render_engine.counters
+    for name in WORKER_CACHES:
+        hits, misses = counters[f'{name}_hits'], counters[f'{name}_misses']
+        yield f'worker_{name}', hits, misses, {'evictions': counters[f'{name}_evictions']}
+
+
+def exposition(bot, prefix='monarchbot'):
+    """Everything the bot measures in the Prometheus text format"""
+    engine = bot.render_engine
+    lines = [
+        f'# TYPE {prefix}_render_workers gauge',
+        f'{prefix}_render_workers {engine.workers}',
+        f'# TYPE {prefix}_render_pending gauge',
+        f'{prefix}_render_pending {engine.pending}',
+        f'# HELP {prefix}_render_queue_depth Jobs waiting for a free worker slot.',
+        f'# TYPE {prefix}_render_queue_depth gauge',
+        f'{prefix}_render_queue_depth {engine.queued}',
+        f'# HELP {prefix}_scheduler_queued Commands waiting for their turn to render.',
+        f'# TYPE {prefix}_scheduler_queued gauge',
+        f'{prefix}_scheduler_queued {bot.scheduler.queued}',
+        f'# TYPE {prefix}_scheduler_running gauge',
+        f'{prefix}_scheduler_running {bot.scheduler.running}',
+        f'# HELP {prefix}_memory_reserved_bytes Memory set aside for the images being rendered.',
+        f'# TYPE {prefix}_memory_reserved_bytes gauge',
+        f'{prefix}_memory_reserved_bytes {bot.memory_budget.reserved}',
+        f'# TYPE {prefix}_memory_peak_bytes gauge',
+        f'{prefix}_memory_peak_bytes {bot.memory_budget.peak}',
+        f'# TYPE {prefix}_memory_budget_bytes gauge',
+        f'{prefix}_memory_budget_bytes {bot.memory_budget.limit}',
+        f'# TYPE {prefix}_cache_hits_total counter',
+        f'# TYPE {prefix}_cache_misses_total counter',
+        f'# TYPE {prefix}_cache_hit_rate gauge',
+    ]
+    for name, hits, misses, stats in cache_stats(bot):
+        lines.append(f'{prefix}_cache_hits_total{{cache="{name}"}} {hits}')
+        lines.append(f'{prefix}_cache_misses_total{{cache="{name}"}} {misses}')
+        lines.append(f'{prefix}_cache_hit_rate{{cache="{name}"}} {hit_rate(hits, misses)}')
+        if 'bytes' in stats:
+            lines.append(f'{prefix}_cache_bytes{{cache="{name}"}} {stats["bytes"]}')
+    for name, value in sorted(engine.counters.items()):
+        if not name.startswith(tuple(f'{cache}_' for cache in WORKER_CACHES)):
+            lines.append(f'{prefix}_render_{name}_total {value}')
+    for name, value in sorted(bot.downloader.counters.items()):
+        lines.append(f'{prefix}_download_{name}_total {value}')
+    for name, value in sorted(bot.scheduler.counters.items()):
+        lines.append(f'{prefix}_scheduler_{name}_total {value}')
+    for name, value in sorted(bot.upload_index.counters.items()):
+        lines.append(f'{prefix}_uploads_{name}_total {value}')
+    for name, value in sorted(bot.memory_budget.counters.items()):
+        lines.append(f'{prefix}_memory_{name}_total {value}')
+    return '\n'.join(lines) + '\n' + bot.metrics.exposition(prefix)
+
+
+class Stats(commands.Cog):
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.runner = None
+        bot.before_invoke(label_command)
+        if METRICS_PORT:
+            bot.loop.create_task(self.serve_metrics())
+
+    def cog_unload(self):
+        if self.runner is not None:
+            self.bot.loop.create_task(self.runner.cleanup())
+
+    async def serve_metrics(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        try:
+            await web.TCPSite(self.runner, METRICS_HOST, METRICS_PORT).start()
+        except OSError as e:
+            logging.warning(f"Couldn't serve metrics on {METRICS_HOST}:{METRICS_PORT}: {e}")
+
+    async def metrics(self, request):
+        return web.Response(body=exposition(self.bot).encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    @commands.command()
+    @commands.is_owner()
+    async def stats(self, ctx):
+        """Queue depth, cache hit rates and how long each stage takes"""
+        engine = self.bot.render_engine
+        scheduler = self.bot.scheduler
+        memory = self.bot.memory_budget
+        lines = [f"Render queue: {engine.queued} waiting, {engine.pending} pending, {engine.workers} workers",
+                 f"Scheduler: {scheduler.queued} in line from {len(scheduler.guilds)} guilds, "
+                 f"{scheduler.running} of {scheduler.concurrency} running",
+                 f"Memory: {memory.reserved / 2**20:.1f}MB reserved by {memory.rendering} renders, "
+                 f"{memory.peak / 2**20:.1f}MB at most, of {memory.limit / 2**20:.0f}MB, "
+                 f"{memory.counters['downscaled']} downscaled", ""]
+        for name, hits, misses, stats in cache_stats(self.bot):
+            lines.append(f"{name + ' cache':28} {hit_rate(hits, misses):6.1%} of {hits + misses} lookups")
+        lines.append("")
+        for stage, histogram in sorted(self.bot.metrics.by_stage().items()):
+            lines.append(f"{stage:10} p50 {histogram.quantile(0.5) * 1000:8.1f}ms  "
+                         f"p95 {histogram.quantile(0.95) * 1000:8.1f}ms  n={histogram.count}")
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+
+def setup(bot):
+    bot.add_cog(Stats(bot))
@@ -0,0 +1,58 @@
+import functools
+from PIL import ImageDraw, ImageFont
+
+
+FONT_PATH = "fonts/impact.ttf"
+
+
+@functools.lru_cache(maxsize=64)
+def get_font(size):
+    """The impact font at 'size', loaded once per size"""
+    return ImageFont.truetype(font=FONT_PATH, size=size)
+
+
+@functools.lru_cache(maxsize=4096)
+def word_width(font, word):
+    return font.getlength(word)
+
+
+def wrap_text(font, text, width):
+    """
+    Breaks the lines of 'text' so they're narrower than 'width', only between words.
+    Words are measured once and lines are filled greedily, words wider than 'width' get their own line.
+    """
+    space = word_width(font, ' ')
+    lines = []
+    for paragraph in text.splitlines():
+        line = []
+        line_width = 0
+        for word in paragraph.split():
+            w = word_width(font, word)
+            if line and line_width + space + w >= width:
+                lines.append(' '.join(line))
+                line = []
+            line_width = line_width + space + w if line else w
+            line.append(word)
+        lines.append(' '.join(line))
+    return '\n'.join(lines).strip('\n')
+
+
+def draw_caption(image, text, position='top'):
+    """
+    Draws 'text' in white with a black outline, centered at the 'top' or 'bottom' of 'image'.
+    The font size and outline follow the width of the image.
+    """
+    font_size = max(image.width // 10, 1)
+    font = get_font(font_size)
+    stroke = font_size // 20
+    text = wrap_text(font, text, image.width)
+    if not text:
+        return image
+    draw = ImageDraw.Draw(image)
+    left, top, right, bottom = draw.multiline_textbbox((0, 0), text, font=font, align="center", stroke_width=stroke)
+    x = (image.width - (right - left)) // 2 - left
+    # the bottom caption is as far from the bottom edge as the top one is from the top
+    y = 3 if position == 'top' else image.height - bottom - top - 3
+    draw.multiline_text((x, y), text, font=font, fill=(255, 255, 255, 255), align="center",
+                        stroke_width=stroke, stroke_fill=(0, 0, 0, 255))
+    return image
@@ -0,0 +1,105 @@
+import collections
+import hashlib
+import os
+import time
+from discord.ext import commands
+
+
+# seconds an upload is pointed at instead of uploading the same result again, Discord's links don't last forever
+UPLOAD_REUSE_TTL = float(os.environ.get('UPLOAD_REUSE_TTL', 60 * 60))
+
+# where a result was last uploaded, 'expires' is a time.monotonic() time
+Upload = collections.namedtuple('Upload', 'channel_id message_id attachment expires')
+
+
+def content_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class UploadIndex:
+    """
+    Remembers where results were last uploaded in each guild, by the hash of their content,
+    so a result that's already there can be pointed at instead of uploaded again.
+    At most 'max_uploads' are remembered for 'ttl' seconds each, dropping the least recently used ones.
+    Uploads are forgotten as soon as their message or channel is deleted.
+    """
+
+    def __init__(self, max_uploads=5000, ttl=UPLOAD_REUSE_TTL):
+        self.max_uploads = max_uploads
+        self.ttl = ttl
+        self.uploads = collections.OrderedDict()  # (scope, digest) -> Upload
+        self.messages = {}  # message_id -> (scope, digest)
+        self.hits = 0
+        self.misses = 0
+        # what was uploaded and what wasn't thanks to the index, in files and bytes
+        self.counters = collections.Counter()
+
+    def get(self, scope, digest):
+        """The Upload of the result with 'digest' in 'scope', a guild or DM channel id, or None"""
+        key = (scope, digest)
+        upload = self.uploads.get(key)
+        if upload is not None and upload.expires <= time.monotonic():
+            self._forget(key)
+            upload = None
+        if upload is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.uploads.move_to_end(key)
+        return upload
+
+    def add(self, scope, digest, channel_id, message_id, attachment):
+        key = (scope, digest)
+        if key in self.uploads:
+            self._forget(key)
+        self.uploads[key] = Upload(channel_id, message_id, attachment, time.monotonic() + self.ttl)
+        self.messages[message_id] = key
+        while len(self.uploads) > self.max_uploads:
+            self._forget(next(iter(self.uploads)))
+
+    def remove(self, message_ids):
+        for message_id in message_ids:
+            key = self.messages.get(message_id)
+            if key is not None:
+                self._forget(key)
+
+    def remove_channel(self, channel_id):
+        self.remove([upload.message_id for upload in self.uploads.values() if upload.channel_id == channel_id])
+
+    def _forget(self, key):
+        upload = self.uploads.pop(key)
+        del self.messages[upload.message_id]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'uploads': len(self.uploads),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class UploadTracker(commands.Cog):
+
+    def __init__(self, bot):
+        self.bot = bot
+
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        self.bot.upload_index.remove({payload.message_id})
+
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload):
+        self.bot.upload_index.remove(payload.message_ids)
+
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        self.bot.upload_index.remove_channel(channel.id)
+
+
+def setup(bot):
+    bot.add_cog(UploadTracker(bot))
@@ -0,0 +1,288 @@
+"""
+An in-process stand-in for the parts of Discord the cogs use, so commands can run without a gateway.
+
+Channels keep their messages for history, attachments are served by a fake CDN through the bot's
+downloader, and what commands send is posted back to the channel as the bot, where later commands
+find it like they would on Discord. Every request waits as long as the Latencies say it takes.
+Commands go through the bot's own parsing, checks and hooks:
+
+    fake = FakeDiscord(create_bot())
+    channel = fake.channel(fake.guild())
+    user = fake.member('someone')
+    fake.upload(channel, user, data, 'cat.png')
+    ctx = await fake.command(channel, user, '-grayscale')
+    ctx.replies  # the messages the command sent
+"""
+import asyncio
+import hashlib
+import io
+import itertools
+import random
+import types
+import urllib.parse
+from discord.ext import commands
+from PIL import Image
+from cogs.download import Downloader, DownloadError, ImageGone
+
+
+class Latencies:
+    """
+    Seconds each kind of request to Discord takes, varied by up to 'jitter' of them either way
+    With a 'bandwidth' in bytes per second, downloads and uploads take longer the bigger they are
+    """
+
+    def __init__(self, typing=0.05, history=0.1, download=0.1, upload=0.3, delete=0.05, jitter=0.5, bandwidth=0):
+        self.typing = typing
+        self.history = history
+        self.download = download
+        self.upload = upload
+        self.delete = delete
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+
+    async def wait(self, request, size=0):
+        seconds = getattr(self, request) * random.uniform(1 - self.jitter, 1 + self.jitter)
+        if self.bandwidth:
+            seconds += size / self.bandwidth
+        await asyncio.sleep(seconds)
+
+
+class FakeUser:
+
+    def __init__(self, id, name, bot=False):
+        self.id = id
+        self.name = self.display_name = name
+        self.bot = bot
+        self.mention = f'<@{id}>'
+
+
+class FakeGuild:
+
+    def __init__(self, id, me):
+        self.id = id
+        self.me = me
+
+
+def _signature(address):
+    """The query Discord signs the link to the file at 'address' with, the fake CDN checks it's there"""
+    return {'ex': '7fffffff', 'is': '00000000', 'hm': hashlib.blake2b(address.encode(), digest_size=32).hexdigest()}
+
+
+def _signed(address):
+    return f'{address}?{urllib.parse.urlencode(_signature(address))}&'
+
+
+class FakeAttachment:
+    """An uploaded file, its size is read from its header like Discord does"""
+
+    def __init__(self, fake, channel, data, filename):
+        self.id = fake.next_id()
+        self.filename = filename
+        self.size = len(data)
+        self.data = data
+        self._fake = fake
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                self.width, self.height = image.size
+        except OSError:
+            self.width = self.height = None
+        address = f'https://cdn.discordapp.com/attachments/{channel.id}/{self.id}/{filename}'
+        proxy_address = f'https://media.discordapp.net/attachments/{channel.id}/{self.id}/{filename}'
+        # signed links, like the ones Discord gives out
+        self.url = _signed(address)
+        self.proxy_url = _signed(proxy_address)
+        fake.files[address] = fake.files[proxy_address] = data
+
+    async def read(self, use_cached=False):
+        await self._fake.latencies.wait('download', self.size)
+        return self.data
+
+    async def save(self, fp, seek_begin=True, use_cached=False):
+        data = await self.read()
+        written = fp.write(data)
+        if seek_begin:
+            fp.seek(0)
+        return written
+
+
+class FakeMessage:
+
+    def __init__(self, channel, author, content, attachments, embeds=()):
+        self.id = channel.fake.next_id()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content or ''
+        self.attachments = list(attachments)
+        self.embeds = list(embeds)
+        self.mentions = self.role_mentions = []
+        self.webhook_id = None
+        self._state = channel.fake.bot._connection
+
+    async def delete(self, delay=None):
+        if delay is not None:
+            await asyncio.sleep(delay)
+        await self.channel.fake.latencies.wait('delete')
+        if self in self.channel.messages:
+            self.channel.messages.remove(self)
+            for attachment in self.attachments:
+                self.channel.fake.forget(attachment)
+            payload = types.SimpleNamespace(channel_id=self.channel.id, message_id=self.id,
+                                            guild_id=self.guild and self.guild.id, cached_message=self)
+            self.channel.fake.bot.dispatch('raw_message_delete', payload)
+
+
+class FakeChannel:
+    """A channel that remembers its last 'max_messages' messages, the files of older ones are gone from the CDN"""
+
+    def __init__(self, fake, guild, max_messages=200):
+        self.fake = fake
+        self.id = fake.next_id()
+        self.guild = guild
+        self.max_messages = max_messages
+        self.messages = []
+
+    def post(self, author, content=None, attachments=(), embeds=(), dispatch=True):
+        """Adds a message to the channel, telling the bot about it unless 'dispatch' is False"""
+        message = FakeMessage(self, author, content, attachments, embeds)
+        self.messages.append(message)
+        if len(self.messages) > self.max_messages:
+            for attachment in self.messages.pop(0).attachments:
+                self.fake.forget(attachment)
+        if dispatch:
+            self.fake.bot.dispatch('message', message)
+        return message
+
+    async def history(self, limit=100, before=None):
+        """Yields the messages before 'before', newest first, a page of 100 at a time like Discord"""
+        messages = [m for m in reversed(self.messages) if before is None or m.id < before.id]
+        if limit is not None:
+            messages = messages[:limit]
+        for index, message in enumerate(messages):
+            if index % 100 == 0:
+                await self.fake.latencies.wait('history')
+            yield message
+
+
+class FakeContext(commands.Context):
+    """A command's context whose requests go to the fake channel, with what it sent in 'replies'"""
+
+    def __init__(self, **attrs):
+        super().__init__(**attrs)
+        self.replies = []
+
+    async def send(self, content=None, *, file=None, files=None, embed=None, delete_after=None, **kwargs):
+        files = files or ([file] if file is not None else [])
+        attachments = [FakeAttachment(self.channel.fake, self.channel, f.fp.read(), f.filename) for f in files]
+        await self.channel.fake.latencies.wait('upload', sum(attachment.size for attachment in attachments))
+        message = self.channel.post(self.channel.fake.user, content, attachments, [embed] if embed is not None else [])
+        self.replies.append(message)
+        if delete_after is not None:
+            asyncio.ensure_future(message.delete(delay=delete_after))
+        return message
+
+    async def trigger_typing(self):
+        await self.channel.fake.latencies.wait('typing')
+
+    def history(self, *, limit=100, before=None, **kwargs):
+        return self.channel.history(limit, before)
+
+
+class FakeDownloader(Downloader):
+    """The bot's downloader with the fake CDN instead of the network, downscaling like the media proxy"""
+
+    def __init__(self, fake, **kwargs):
+        super().__init__(**kwargs)
+        self.fake = fake
+
+    def _serve(self, url):
+        """The data of the file at 'url' and the parameters of its query, the data is None if there's no such file"""
+        address, _, query = url.partition('?')
+        params = dict(urllib.parse.parse_qsl(query))
+        if any(params.get(name) != value for name, value in _signature(address).items()):
+            return None, params
+        return self.fake.files.get(address), params
+
+    async def exists(self, url):
+        await self.fake.latencies.wait('download')
+        data, params = self._serve(url)
+        return data is not None
+
+    async def fetch(self, url):
+        data, params = self._serve(url)
+        if data is None:
+            raise ImageGone("The image doesn't exist anymore.")
+        if 'width' in params and 'height' in params:
+            # the media proxy shrinks the file to the size it's asked for
+            resized = self.fake.files.get(url)
+            if resized is None:
+                loop = asyncio.get_event_loop()
+                resized = await loop.run_in_executor(None, _downscale, data, int(params['width']),
+                                                     int(params['height']))
+                self.fake.files[url] = resized
+            data = resized
+        await self.fake.latencies.wait('download', len(data))
+        if len(data) > self.max_bytes:
+            self.counters['stopped'] += 1
+            raise DownloadError("That image is too big.")
+        self._check_format(data)
+        self.counters['downloaded'] += 1
+        self.counters['bytes'] += len(data)
+        return data
+
+
+def _downscale(data, width, height):
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.resize((width, height), Image.LANCZOS)
+        f = io.BytesIO()
+        image.save(f, 'PNG' if image.mode in ('RGBA', 'LA', 'P') else 'JPEG')
+        return f.getvalue()
+
+
+class FakeDiscord:
+    """Where the fake guilds, channels, users and files of 'bot' come from"""
+
+    def __init__(self, bot, latencies=None):
+        self.bot = bot
+        self.latencies = latencies or Latencies()
+        self._ids = itertools.count(1)
+        # the fake CDN, the address of a file or a downscaled url -> data
+        self.files = {}
+        self.user = FakeUser(self.next_id(), bot.__class__.__name__, bot=True)
+        # the bot never logs in, making commands only needs its id
+        bot._connection.user = self.user
+        bot.downloader = FakeDownloader(self)
+
+    def next_id(self):
+        return next(self._ids)
+
+    def forget(self, attachment):
+        """Takes the files of 'attachment' off the CDN"""
+        addresses = (attachment.url.partition('?')[0], attachment.proxy_url.partition('?')[0])
+        for url in [url for url in self.files if url.startswith(addresses)]:
+            del self.files[url]
+
+    def guild(self):
+        return FakeGuild(self.next_id(), self.user)
+
+    def channel(self, guild=None):
+        return FakeChannel(self, guild)
+
+    def member(self, name):
+        return FakeUser(self.next_id(), name)
+
+    def upload(self, channel, author, data, filename, content=None):
+        """Posts 'data' in 'channel' as 'author' and returns the message"""
+        return channel.post(author, content, [FakeAttachment(self, channel, data, filename)])
+
+    async def command(self, channel, author, content, files=()):
+        """
+        Runs the command in 'content' sent by 'author' with the (data, filename) 'files' attached
+        Returns its context once it's done, errors are dispatched to on_command_error like on Discord
+        """
+        attachments = [FakeAttachment(self, channel, data, filename) for data, filename in files]
+        # not dispatched, or the bot would invoke it a second time with a real context
+        message = channel.post(author, content, attachments, dispatch=False)
+        ctx = await self.bot.get_context(message, cls=FakeContext)
+        await self.bot.invoke(ctx)
+        return ctx
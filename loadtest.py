@@ -0,0 +1,274 @@
+"""
+Fires a mix of commands at the bot's real cogs through fake_discord.py and reports how much it sustains.
+
+    python3 loadtest.py --duration 30 --users 16
+    python3 loadtest.py --rate 20 -m 3:grayscale -m "1:pipe invert tv" -l upload=0.5 -o results.json
+
+Without --rate every user sends their next command as soon as the last one is answered, which finds
+the most commands per second one process handles. With --rate commands arrive at that rate whether
+or not the bot keeps up, which shows the latencies users would see at that load.
+Commands are picked from the mix by weight, by default every filter and a few frames and templates,
+and some of them come with a new upload so the caches don't answer everything. Discord's latencies
+are set with -l, see fake_discord.Latencies.
+The report has the throughput, latency percentiles by command, how late the event loop ran
+and the time spent in each stage, the results of the first --warmup seconds aren't counted.
+"""
+import argparse
+import asyncio
+import collections
+import io
+import json
+import math
+import os
+import random
+import sys
+import time
+from PIL import Image
+
+
+# how often the event loop is checked for lag, in seconds
+LAG_INTERVAL = 0.01
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of the sorted list 'ordered'"""
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(seconds):
+    """Percentiles in milliseconds of the list 'seconds'"""
+    if not seconds:
+        return {'count': 0}
+    ordered = sorted(seconds)
+    return {
+        'count': len(ordered),
+        'p50': percentile(ordered, 0.5) * 1000,
+        'p90': percentile(ordered, 0.9) * 1000,
+        'p99': percentile(ordered, 0.99) * 1000,
+        'max': ordered[-1] * 1000,
+    }
+
+
+def parse_mix(entries):
+    """Reads 'weight:command' entries into [(command, weight)], the weight is 1 if it's left out"""
+    mix = []
+    for entry in entries:
+        weight, _, command = entry.partition(':')
+        if command and weight.isdigit():
+            mix.append((command, int(weight)))
+        else:
+            mix.append((entry, 1))
+    return mix
+
+
+def default_mix(bot):
+    from cogs.filters import filters
+    registry = bot.asset_registry
+    frames = sorted(registry.names('frame'))[:3]
+    templates = sorted(registry.names('template'))[:3]
+    mix = [(name, 2) for name in filters]
+    mix += [('symm', 1), ('rotate left', 1), ('impact top text | bottom text', 1), ('brightness 120', 1)]
+    mix += [(name, 3) for name in frames + templates]
+    # a pipe through a template and a frame, with whichever of them there are
+    assets = templates[:1] + frames[:1]
+    if assets:
+        mix.append(('pipe ' + ' '.join(assets + ['grayscale', 'invert']), 1))
+    return mix
+
+
+def make_image(size):
+    """PNG data of noise over a gradient, about as hard to encode as a photo"""
+    noise = Image.effect_noise(size, 48)
+    gradient = Image.linear_gradient('L').resize(size)
+    image = Image.merge('RGB', (noise, gradient, Image.blend(noise, gradient, 0.5)))
+    f = io.BytesIO()
+    image.save(f, 'PNG')
+    return f.getvalue()
+
+
+class Recorder:
+    """What the commands that started after the warmup took and how they ended"""
+
+    def __init__(self):
+        # set once the guilds, channels and images are ready
+        self.warmup_end = math.inf
+        self.latencies = collections.defaultdict(list)
+        self.outcomes = collections.Counter()
+        self.errors = collections.Counter()
+        self.lag = []
+
+    def command(self, name, start, ctx):
+        if start < self.warmup_end:
+            return
+        self.latencies[name].append(time.perf_counter() - start)
+        if ctx.command_failed:
+            self.outcomes['failed'] += 1
+        elif any(reply.attachments for reply in ctx.replies):
+            self.outcomes['image'] += 1
+        elif any(reply.embeds for reply in ctx.replies):
+            self.outcomes['reused'] += 1
+        elif ctx.replies:
+            self.outcomes['text'] += 1
+        else:
+            self.outcomes['silent'] += 1
+
+
+async def watch_lag(recorder, stop):
+    """Records how much later than asked the event loop wakes up, until 'stop' is set"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        if start >= recorder.warmup_end:
+            recorder.lag.append(time.perf_counter() - start - LAG_INTERVAL)
+
+
+def forget_warmup(bot):
+    bot.metrics.histograms.clear()
+    bot.scheduler.counters.clear()
+    bot.memory_budget.counters.clear()
+    bot.memory_budget.peak = bot.memory_budget.reserved
+    bot.upload_index.counters.clear()
+
+
+async def run_load(fake, args, mix, recorder):
+    from bot import prefix
+    guilds = [fake.guild() for _ in range(args.guilds)]
+    channels = [fake.channel(guild) for guild in guilds for _ in range(args.channels)]
+    users = [fake.member(f'user{i}') for i in range(args.users)]
+    images = [make_image(args.image_size) for _ in range(4)]
+    for channel in channels:
+        fake.upload(channel, random.choice(users), random.choice(images), 'image.png')
+    commands, weights = zip(*mix)
+    recorder.warmup_end = time.perf_counter() + args.warmup
+    deadline = recorder.warmup_end + args.duration
+    uploads = 0
+
+    async def run_command(user):
+        nonlocal uploads
+        channel = random.choice(channels)
+        command = random.choices(commands, weights)[0]
+        files = ()
+        if random.random() < args.upload_ratio:
+            # each upload is a different attachment, even with the same data
+            files = [(random.choice(images), f'upload{uploads}.png')]
+            uploads += 1
+        start = time.perf_counter()
+        ctx = await fake.command(channel, user, prefix + command, files)
+        recorder.command(command.split()[0], start, ctx)
+
+    async def closed_loop(user):
+        while time.perf_counter() < deadline:
+            await run_command(user)
+
+    # the stages and scheduler counters of the warmup aren't counted either
+    loop = asyncio.get_event_loop()
+    loop.call_later(recorder.warmup_end - time.perf_counter(), forget_warmup, fake.bot)
+    stop = asyncio.Event()
+    lag = asyncio.ensure_future(watch_lag(recorder, stop))
+    if args.rate:
+        running = set()
+        while time.perf_counter() < deadline:
+            running.add(asyncio.ensure_future(run_command(random.choice(users))))
+            running = {task for task in running if not task.done()}
+            await asyncio.sleep(random.expovariate(args.rate))
+        if running:
+            await asyncio.wait(running)
+    else:
+        await asyncio.gather(*(closed_loop(user) for user in users))
+    stop.set()
+    await lag
+
+
+def report(bot, recorder, duration):
+    latencies = [seconds for command in recorder.latencies.values() for seconds in command]
+    stages = {stage: {'count': histogram.count, 'p50': histogram.quantile(0.5) * 1000,
+                      'p95': histogram.quantile(0.95) * 1000, 'total': histogram.sum}
+              for stage, histogram in sorted(bot.metrics.by_stage().items())}
+    return {
+        'duration': duration,
+        'commands': len(latencies),
+        'commands_per_second': len(latencies) / duration,
+        'latency_ms': summarize(latencies),
+        'latency_ms_by_command': {command: summarize(seconds) for command, seconds in sorted(recorder.latencies.items())},
+        'outcomes': dict(recorder.outcomes),
+        'errors': dict(recorder.errors),
+        'loop_lag_ms': summarize(recorder.lag),
+        'stages': stages,
+        'scheduler': dict(bot.scheduler.counters),
+        'memory': {**bot.memory_budget.counters, 'peak_bytes': bot.memory_budget.peak},
+        'uploads': dict(bot.upload_index.counters),
+        'render_workers': bot.render_engine.workers,
+    }
+
+
+def print_report(results, file=sys.stderr):
+    latency = results['latency_ms']
+    print(f"{results['commands']} commands in {results['duration']:.1f}s: "
+          f"{results['commands_per_second']:.1f}/s on {results['render_workers']} render workers", file=file)
+    print(f"outcomes: {results['outcomes']}  errors: {results['errors']}  scheduler: {results['scheduler']}",
+          file=file)
+    print(f"memory: {results['memory']}  uploads: {results['uploads']}", file=file)
+    rows = [('all', latency)] + list(results['latency_ms_by_command'].items()) + [('loop lag', results['loop_lag_ms'])]
+    for name, summary in rows:
+        if summary['count']:
+            print(f"{name:12} {summary['count']:7}  p50 {summary['p50']:8.1f} ms  p90 {summary['p90']:8.1f} ms  "
+                  f"p99 {summary['p99']:8.1f} ms  max {summary['max']:8.1f} ms", file=file)
+    for stage, summary in results['stages'].items():
+        print(f"{stage:12} {summary['count']:7}  p50 {summary['p50']:8.1f} ms  p95 {summary['p95']:8.1f} ms  "
+              f"total {summary['total']:8.2f} s", file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-d', '--duration', type=float, default=30, help="seconds to measure for")
+    parser.add_argument('--warmup', type=float, default=5, help="seconds to run before measuring")
+    parser.add_argument('--users', type=int, default=16, help="users sending commands")
+    parser.add_argument('--rate', type=float, help="commands per second, by default users don't wait between commands")
+    parser.add_argument('--guilds', type=int, default=4)
+    parser.add_argument('--channels', type=int, default=2, help="channels per guild")
+    parser.add_argument('-m', '--mix', action='append', help="a 'weight:command' to send, can be repeated")
+    parser.add_argument('--upload-ratio', type=float, default=0.3, help="fraction of commands that come with an upload")
+    parser.add_argument('--image-size', type=lambda size: tuple(map(int, size.split('x'))), default=(1024, 768),
+                        help="WIDTHxHEIGHT of the uploaded images")
+    parser.add_argument('-l', '--latency', action='append', default=[],
+                        help="a 'request=seconds' of fake_discord.Latencies, can be repeated")
+    parser.add_argument('-o', '--output', help="where to write the JSON results")
+    parser.add_argument('--bot-directory', default=os.path.dirname(os.path.abspath(__file__)),
+                        help="where the frames and fonts are, by default this script's directory")
+    args = parser.parse_args(argv)
+
+    output = args.output and os.path.abspath(args.output)
+    # operations find frames and fonts relative to the working directory, like the bot does
+    os.chdir(args.bot_directory)
+    from bot import create_bot
+    from fake_discord import FakeDiscord, Latencies
+    latencies = Latencies(**{name: float(seconds) for name, seconds in
+                             (entry.split('=', 1) for entry in args.latency)})
+
+    bot = create_bot()
+    fake = FakeDiscord(bot, latencies)
+    mix = parse_mix(args.mix) if args.mix else default_mix(bot)
+    recorder = Recorder()
+
+    @bot.event
+    async def on_command_error(ctx, error):
+        recorder.errors[type(getattr(error, 'original', error)).__name__] += 1
+
+    try:
+        bot.loop.run_until_complete(run_load(fake, args, mix, recorder))
+    finally:
+        for extension in list(bot.extensions):
+            bot.unload_extension(extension)
+        bot.render_engine.shutdown()
+        bot.asset_registry.close()
+
+    results = report(bot, recorder, args.duration)
+    print_report(results)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,223 @@
+"""
+Renders pipes on local images with a pool of worker processes, without connecting to Discord.
+
+    python3 render_batch.py photos/ -p "grayscale monarch" -o out/
+    python3 render_batch.py "uploads/**/*.gif" -p monarch -p "invert tv" -o out/ --max-size 0
+
+Inputs are directories, searched recursively, or globs. Every image is rendered with every pipe,
+exactly like the pipe command would, and the results are written to the output directory as they
+finish, keeping their path relative to the directory they were found in, or to the part of the glob
+before its wildcards. A result in another format than its image gets its extension added after the
+image's, like cat.png.jpg, and results are never overwritten by others of the same run. With several
+pipes each gets a subdirectory named after it.
+Frames and templates are read from the asset registry of the bot's directory, so it can be used
+to check new ones on many images at once. Progress and throughput are reported on stderr, and the
+time spent in each stage at the end. The exit status is 1 if any image couldn't be rendered.
+"""
+import argparse
+import asyncio
+import glob
+import os
+import re
+import sys
+import time
+from PIL import Image
+from cogs.image_handling import SourceImage, RenderError, EXTENSIONS, MAX_SIZE
+from cogs.pipeline import parse_pipe, optimize, PipeError
+from cogs.registry import AssetRegistry
+from cogs.render import RenderEngine
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+# how often progress is reported, in seconds
+PROGRESS_INTERVAL = 1.0
+
+
+def glob_root(pattern):
+    """The directory of 'pattern' before its first component with wildcards, a file's own directory if there are none"""
+    if not glob.has_magic(pattern):
+        return os.path.dirname(pattern)
+    while glob.has_magic(pattern):
+        pattern = os.path.dirname(pattern)
+    return pattern
+
+
+def find_images(inputs):
+    """Yields (path, name) of the images of 'inputs', 'name' being where the result goes in the output directory"""
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            for directory, subdirectories, files in os.walk(pattern):
+                subdirectories.sort()
+                for filename in sorted(files):
+                    if filename.lower().endswith(IMAGE_EXTENSIONS):
+                        path = os.path.join(directory, filename)
+                        yield path, os.path.relpath(path, pattern)
+            continue
+        root = glob_root(pattern)
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS):
+                yield path, os.path.relpath(path, root)
+
+
+def output_name(name, format):
+    """Where the result in 'format' of the image 'name' goes, its extension is only replaced if it's already right"""
+    if Image.registered_extensions().get(os.path.splitext(name)[1].lower()) == format:
+        return name
+    return f'{name}.{EXTENSIONS[format]}'
+
+
+def pipe_directory(pipe_string):
+    """A directory name for the results of 'pipe_string'"""
+    return re.sub(r'[^\w.-]+', '_', '_'.join(pipe_string.split()))
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+class Progress:
+    """Counts finished images and reports how fast they go, at most every PROGRESS_INTERVAL seconds"""
+
+    def __init__(self, file=sys.stderr):
+        self.file = file
+        self.start = time.perf_counter()
+        self.last_report = 0
+        # the (done, failed) counts last reported
+        self.reported = None
+        self.done = 0
+        self.failed = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def line(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        return (f"{self.done} rendered, {self.failed} failed in {elapsed:.1f}s: "
+                f"{(self.done + self.failed) / elapsed:.1f} images/s, "
+                f"{self.bytes_read / elapsed / 2**20:.1f} MB/s read, "
+                f"{self.bytes_written / elapsed / 2**20:.1f} MB/s written")
+
+    def update(self):
+        now = time.perf_counter()
+        if now - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = now
+            self.reported = (self.done, self.failed)
+            end = '\r' if self.file.isatty() else '\n'
+            print(self.line(), end=end, file=self.file, flush=True)
+
+    def finish(self):
+        """Ends the progress line, only reporting again if images finished since the last report"""
+        if (self.done, self.failed) != self.reported:
+            print(self.line(), file=self.file)
+        elif self.file.isatty():
+            print(file=self.file)
+
+
+async def render_all(engine, images, plans, output, max_size, progress):
+    """
+    Renders every (path, name) of 'images' with every (directory, plan) of 'plans' and writes the results
+    Only a few images more than the engine can take are read at once, so any number of them can be rendered
+    """
+    loop = asyncio.get_event_loop()
+    # destination -> the image whose result was written there
+    written = {}
+
+    async def render_one(path, name):
+        try:
+            data = await loop.run_in_executor(None, read_file, path)
+        except OSError as e:
+            progress.failed += len(plans)
+            print(f"{path}: {e}", file=sys.stderr)
+            return
+        progress.bytes_read += len(data)
+        # keyed by path so the workers decode an image once for all the pipes
+        source = SourceImage(data, path)
+        for directory, plan in plans:
+            try:
+                encoded = await engine.render(source, plan, max_size)
+                destination = os.path.join(output, directory, output_name(name, encoded.format))
+                if destination in written:
+                    raise RenderError(f"{destination} is already the result of {written[destination]}")
+                written[destination] = path
+                await loop.run_in_executor(None, write_file, destination, encoded.data)
+            except (RenderError, OSError) as e:
+                progress.failed += 1
+                print(f"{path}: {e}", file=sys.stderr)
+                continue
+            except Exception as e:
+                # a bug in an operation fails the image, not the whole run
+                progress.failed += 1
+                print(f"{path}: {type(e).__name__}: {e}", file=sys.stderr)
+                continue
+            progress.done += 1
+            progress.bytes_written += len(encoded.data)
+            progress.update()
+
+    running = set()
+    for path, name in images:
+        if len(running) >= engine.max_pending:
+            finished, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                task.result()
+        running.add(loop.create_task(render_one(path, name)))
+    if running:
+        await asyncio.gather(*running)
+
+
+def report_stages(metrics, file=sys.stderr):
+    for stage, histogram in sorted(metrics.by_stage().items()):
+        print(f"{stage:10} {histogram.count:8} runs  p50 {histogram.quantile(0.5) * 1000:8.2f} ms  "
+              f"p95 {histogram.quantile(0.95) * 1000:8.2f} ms  total {histogram.sum:8.2f} s", file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help="directories or globs of images")
+    parser.add_argument('-p', '--pipe', action='append', required=True, help="a pipe to render, can be repeated")
+    parser.add_argument('-o', '--output', required=True, help="directory to write the results to")
+    parser.add_argument('-j', '--workers', type=int, help="worker processes, by default RENDER_WORKERS or one per CPU")
+    parser.add_argument('--max-size', type=int, default=MAX_SIZE,
+                        help=f"size images are shrunk to fit before rendering, 0 keeps them whole (default {MAX_SIZE})")
+    parser.add_argument('--bot-directory', default=os.path.dirname(os.path.abspath(__file__)),
+                        help="where the frames and fonts are, by default this script's directory")
+    args = parser.parse_args(argv)
+
+    inputs = [os.path.abspath(pattern) for pattern in args.inputs]
+    output = os.path.abspath(args.output)
+    # operations find frames and fonts relative to the working directory, like the bot does
+    os.chdir(args.bot_directory)
+    registry = AssetRegistry('frames')
+    try:
+        plans = []
+        for pipe_string in args.pipe:
+            try:
+                operations = parse_pipe(pipe_string, registry.assets)
+            except PipeError as e:
+                print(f"{pipe_string}: {e}", file=sys.stderr)
+                return 2
+            directory = pipe_directory(pipe_string) if len(args.pipe) > 1 else ''
+            plans.append((directory, optimize(tuple(operations))))
+    finally:
+        registry.close()
+
+    engine = RenderEngine(args.workers)
+    progress = Progress()
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(render_all(engine, find_images(inputs), plans, output, args.max_size or None,
+                                           progress))
+    finally:
+        engine.shutdown()
+    progress.finish()
+    report_stages(engine.metrics)
+    return 1 if progress.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
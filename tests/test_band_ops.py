@@ -0,0 +1,119 @@
+"""
+transparent() and detect_template() work on whole bands at once, these check they still give
+exactly what the per-pixel loops they replaced gave.
+"""
+import random
+import pytest
+from PIL import Image
+from cogs.filters import transparent
+from cogs.frames import detect_template
+
+
+def loop_transparent(image):
+    image = image.convert("RGBA")
+    alpha = image.getchannel('A')
+    p = 0
+    for (r, g, b, a) in image.getdata():
+        if abs(r-g) + abs(g-b) < 10:
+            x = p % alpha.width
+            y = p // alpha.width
+            if a > 255 - min(r, g, b):
+                alpha.putpixel((x, y), 255 - min(r, g, b))
+        p += 1
+    image.putalpha(alpha)
+    return image
+
+
+def loop_detect_template(image):
+    try:
+        image = image.getchannel('A')
+    except ValueError:
+        return None
+    x1 = image.width
+    y1 = image.height
+    x2 = 0
+    y2 = 0
+    i = 0
+    for pixel in image.getdata():
+        if pixel != 255:
+            x = i % image.width
+            y = i // image.width
+            if x < x1:
+                x1 = x
+            if y < y1:
+                y1 = y
+            if x > x2:
+                x2 = x
+            if y > y2:
+                y2 = y
+        i += 1
+    return x1, y1, x2, y2
+
+
+MODES = ('RGB', 'RGBA', 'L', 'P', 'LA')
+SIZE = (37, 23)
+
+
+def random_image(mode, seed, alpha=None):
+    """An image in 'mode' with random pixels, lots of them grayish, 'alpha' fixes the alpha band"""
+    rng = random.Random(seed)
+    pixels = []
+    for _ in range(SIZE[0] * SIZE[1]):
+        r = rng.randrange(256)
+        if rng.random() < 0.5:
+            g = min(255, max(0, r + rng.randint(-6, 6)))
+            b = min(255, max(0, g + rng.randint(-6, 6)))
+        else:
+            g, b = rng.randrange(256), rng.randrange(256)
+        a = rng.choice((0, 255, rng.randrange(256))) if alpha is None else alpha
+        pixels.append((r, g, b, a))
+    image = Image.new('RGBA', SIZE)
+    image.putdata(pixels)
+    if mode == 'P':
+        # a palette with a transparent entry, like GIFs and paletted PNGs have
+        image = image.quantize(64)
+        image.info['transparency'] = 0
+        return image
+    return image.convert(mode)
+
+
+def transparency_box(mode, seed, box):
+    """A fully opaque RGBA or LA image with transparency only inside 'box'"""
+    image = random_image('RGBA', seed, alpha=255)
+    image.paste((0, 0, 0, 0), box)
+    return image.convert(mode)
+
+
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('seed', range(3))
+def test_transparent(mode, seed):
+    image = random_image(mode, seed)
+    assert transparent(image).tobytes() == loop_transparent(image).tobytes()
+
+
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('alpha', (0, 255))
+def test_transparent_uniform_alpha(mode, alpha):
+    image = random_image(mode, 7, alpha=alpha)
+    assert transparent(image).tobytes() == loop_transparent(image).tobytes()
+
+
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('seed', range(3))
+def test_detect_template(mode, seed):
+    image = random_image(mode, seed)
+    assert detect_template(image) == loop_detect_template(image)
+
+
+@pytest.mark.parametrize('mode', ('RGBA', 'LA'))
+@pytest.mark.parametrize('box', ((5, 3, 20, 17), (0, 0, 1, 1), (36, 22, 37, 23)))
+def test_detect_template_box(mode, box):
+    image = transparency_box(mode, 1, box)
+    assert detect_template(image) == loop_detect_template(image)
+
+
+@pytest.mark.parametrize('mode', MODES)
+@pytest.mark.parametrize('alpha', (0, 255))
+def test_detect_template_uniform_alpha(mode, alpha):
+    image = random_image(mode, 7, alpha=alpha)
+    assert detect_template(image) == loop_detect_template(image)